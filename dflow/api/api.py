@@ -1,40 +1,85 @@
-from typing import List
+from contextlib import asynccontextmanager
+from typing import List, Optional
 import uuid
 import os
+import time
+import asyncio
 import base64
 import subprocess
 import shutil
-import tarfile
 from pydantic import BaseModel
 import yaml
 import json
 from openapi_spec_validator import openapi_v3_spec_validator
 
-from fastapi import FastAPI, File, UploadFile, status, HTTPException, Security, Body
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, status, HTTPException, Security, Body, Request, Header
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import APIKeyHeader
 
 from starlette.status import (
     HTTP_200_OK,
     HTTP_201_CREATED,
+    HTTP_202_ACCEPTED,
+    HTTP_304_NOT_MODIFIED,
     HTTP_400_BAD_REQUEST,
     HTTP_401_UNAUTHORIZED,
     HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
     HTTP_422_UNPROCESSABLE_ENTITY
 )
 
-from dflow.language import build_model, merge_models
-from dflow.generator import codegen as rasa_generator
+from dflow.language import warm_metamodels
+from dflow.api.executor import BoundedExecutor, ExecutorBusy
+from dflow.api.jobs import JobStore, DONE, FAILED
+from dflow.api.tasks import (
+    ARCHIVE_COMPRESSLEVEL, validate_model, validate_model_result,
+    generate_archive, merge_models, openapi_to_dflow
+)
+from dflow.archive import ARCHIVE_MEDIA_TYPES
+from dflow.cache import ResultCache
 
 from dflow import definitions as CONSTANTS
-from dflow.m2m.openapi_to_dflow import openapi_to_dflow
 
 API_KEY = os.getenv("API_KEY", "123")
 
 api_keys = [API_KEY]
 
-api = FastAPI()
+# Generated archives, served again while the model and generator are unchanged
+RESULT_CACHE = ResultCache(
+    maxsize=int(os.getenv("RESULT_CACHE_SIZE", 256)),
+    max_bytes=int(os.getenv("RESULT_CACHE_BYTES", 256 * 1024 * 1024))
+)
+
+# Runs the blocking work of the endpoints, off the event loop
+EXECUTOR = BoundedExecutor.from_env(initializer=warm_metamodels)
+
+# Background codegen jobs, for models that take longer than a request may
+JOBS = JobStore.from_env(initializer=warm_metamodels)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Compile the grammar before the worker starts accepting requests
+    warm_metamodels()
+    EXECUTOR.start()
+    # Jobs left queued or running by a previous run of this worker
+    JOBS.purge()
+    yield
+    EXECUTOR.shutdown()
+    JOBS.shutdown()
+
+
+api = FastAPI(lifespan=lifespan)
+
+
+@api.exception_handler(ExecutorBusy)
+async def executor_busy_handler(request: Request, exc: ExecutorBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 api_key_header = APIKeyHeader(name="X-API-Key")
 
@@ -81,14 +126,12 @@ async def validate(model: ValidationModel, api_key: str = Security(get_api_key))
     if len(text) == 0:
         return 404
     resp = {"status": 200, "message": ""}
-    u_id = uuid.uuid4().hex[0:8]
-    fpath = os.path.join(CONSTANTS.TMP_DIR, f"model_for_validation-{u_id}.dflow")
-    with open(fpath, "w") as f:
-        f.write(text)
     try:
-        build_model(fpath)
+        await EXECUTOR.run(validate_model, text)
         print("Model validation success!!")
         resp["message"] = "Model validation success"
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print(f"Exception while validating model: {e}")
         raise HTTPException(status_code=400, detail=f"Validation error: {e}")
@@ -104,14 +147,12 @@ async def validate_file(
     )
     resp = {"status": 200, "message": ""}
     fd = file.file
-    u_id = uuid.uuid4().hex[0:8]
-    fpath = os.path.join(CONSTANTS.TMP_DIR, f"model_for_validation-{u_id}.dflow")
-    with open(fpath, "w") as f:
-        f.write(fd.read().decode("utf8"))
     try:
-        model = build_model(fpath)
+        await EXECUTOR.run(validate_model, fd.read())
         print("Model validation success!!")
         resp["message"] = "Model validation success"
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print(f"Exception while validating model\n{e}")
         resp["status"] = 404
@@ -126,14 +167,12 @@ async def validate_b64(base64_model: str, api_key: str = Security(get_api_key)):
         return 404
     resp = {"status": 200, "message": ""}
     fdec = base64.b64decode(base64_model)
-    u_id = uuid.uuid4().hex[0:8]
-    fpath = os.path.join(CONSTANTS.TMP_DIR, f"model_for_validation-{u_id}.dflow")
-    with open(fpath, "wb") as f:
-        f.write(fdec)
     try:
-        model = build_model(fpath)
+        await EXECUTOR.run(validate_model, fdec)
         print("Model validation success!!")
         resp["message"] = "Model validation success"
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print(f"Exception while validating model\n{e}")
         resp["status"] = 404
@@ -142,8 +181,47 @@ async def validate_b64(base64_model: str, api_key: str = Security(get_api_key)):
     return resp
 
 
+@api.post("/validate/batch")
+async def validate_batch(models: List[ValidationModel], api_key: str = Security(get_api_key)):
+    """
+        Validates many models on the API executor and streams one NDJSON
+        line per model as it finishes, followed by a summary line.
+    """
+    if not len(models):
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="No models provided!",
+        )
+    # Never hold more executor slots than there are workers, so a large
+    # batch does not push other requests out of the queue.
+    slots = asyncio.Semaphore(EXECUTOR.workers)
+
+    async def validate_one(model: ValidationModel) -> dict:
+        async with slots:
+            try:
+                return await EXECUTOR.run(validate_model_result, model.name, model.model)
+            except ExecutorBusy as e:
+                return {'model': model.name, 'valid': False, 'error': str(e), 'duration': 0}
+
+    async def results():
+        start = time.perf_counter()
+        valid = 0
+        for task in asyncio.as_completed([validate_one(m) for m in models]):
+            result = await task
+            valid += result['valid']
+            yield json.dumps(result) + '\n'
+        yield json.dumps({'summary': {
+            'total': len(models),
+            'valid': valid,
+            'invalid': len(models) - valid,
+            'duration': round(time.perf_counter() - start, 4)
+        }}) + '\n'
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
+
+
 @api.post("/merge")
-async def merge(models: list[UploadFile], api_key: str = Security(get_api_key)) -> FileResponse:
+async def merge(models: list[UploadFile], api_key: str = Security(get_api_key)) -> Response:
     if not len(models):
         raise HTTPException(
             status_code=HTTP_400_BAD_REQUEST,
@@ -151,73 +229,96 @@ async def merge(models: list[UploadFile], api_key: str = Security(get_api_key))
         )
     try:
         model_content = [(await file.read()).decode("utf-8") for file in models]
-        merged_model = merge_models(model_content)
-        merged_model_path = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f'merged-{uuid.uuid4().hex[0:8]}.dflow'
-        )
-        with open(merged_model_path, "w") as f:
-            f.write(merged_model)
-        return FileResponse(
-            merged_model_path,
-            filename=os.path.basename(merged_model_path)
+        merged_model = await EXECUTOR.run(merge_models, model_content,
+                                          [file.filename for file in models])
+        filename = f'merged-{uuid.uuid4().hex[0:8]}.dflow'
+        return Response(
+            content=merged_model,
+            media_type='text/plain',
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
         )
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print(f"Exception while merging dflow models\n{e}")
         raise HTTPException(status_code=400, detail=f"Codegen error: {e}")
 
+async def archive_response(model_str,
+                           archive: str,
+                           compresslevel: int,
+                           if_none_match: str = None,
+                           async_actions: bool = False) -> Response:
+    """
+        Generates the Rasa sources of a model and sends them as an archive.
+        Archives are cached by their inputs; clients that send back the ETag
+        of an unchanged model get a 304 instead.
+
+        A 304 is only sent for an archive that was generated, i.e. for a
+        valid model: a matching ETag that is not cached (e.g. evicted, or
+        made up by the client) generates the archive first.
+    """
+    if compresslevel is None:
+        compresslevel = ARCHIVE_COMPRESSLEVEL
+    key = RESULT_CACHE.key(model_str, archive=archive, compresslevel=compresslevel,
+                           async_actions=async_actions)
+    etag = f'W/"{key}"'
+
+    content = RESULT_CACHE.get(key)
+    if content is None:
+        content = await EXECUTOR.run(generate_archive, model_str, f'codegen-{key[:8]}',
+                                     archive, compresslevel, async_actions)
+        RESULT_CACHE.put(key, content)
+    if if_none_match and etag_matches(etag, if_none_match):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(
+        content=content,
+        media_type=ARCHIVE_MEDIA_TYPES[archive],
+        headers={
+            'Content-Disposition': f'attachment; filename="codegen-{key[:8]}.{archive}"',
+            'ETag': etag,
+        }
+    )
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """ Weak comparison of an ETag against an If-None-Match header. """
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque for tag in if_none_match.split(','))
+
+
 @api.post("/generate/file")
 async def gen_from_file(model_file: UploadFile = File(...),
+                        archive: str = 'tar.gz',
+                        compresslevel: Optional[int] = None,
+                        async_actions: bool = False,
+                        if_none_match: Optional[str] = Header(None),
                         api_key: str = Security(get_api_key)):
     try:
         fd = model_file.file
-        uid = uuid.uuid4().hex[0:8]
-        fpath = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f"model_for_codegen-{uid}.dflow"
-        )
-        with open(fpath, "wb") as f:
-            f.write(fd.read())
-        out_path = rasa_generator(
-            fpath,
-            output_path=os.path.join(CONSTANTS.TMP_DIR, f'codegen-{uid}')
-        )
-        tarball_path = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f'codegen-{uid}.tar.gz'
-        )
-        make_tarball(out_path, tarball_path)
-        return FileResponse(tarball_path,
-                            filename=os.path.basename(tarball_path),
-                            media_type='application/x-tar')
+        return await archive_response(fd.read(), archive, compresslevel, if_none_match,
+                                      async_actions)
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print(f"Exception while generating rasa sources\n{e}")
         raise HTTPException(status_code=400, detail=f"Codegen error: {e}")
 
 
 @api.post("/generate/b64")
-async def gen_model_b64(fenc: str = '', api_key: str = Security(get_api_key)):
+async def gen_model_b64(fenc: str = '',
+                        archive: str = 'tar.gz',
+                        compresslevel: Optional[int] = None,
+                        async_actions: bool = False,
+                        if_none_match: Optional[str] = Header(None),
+                        api_key: str = Security(get_api_key)):
     model_dec = base64.b64decode(fenc)
     try:
-        uid = uuid.uuid4().hex[0:8]
-        fpath = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f"model_for_codegen-{uid}.dflow"
-        )
-        with open(fpath, 'w') as f:
-            f.write(model_dec)
-        out_path = rasa_generator(
-            fpath,
-            output_path=os.path.join(CONSTANTS.TMP_DIR, f'codegen-{uid}')
-        )
-        tarball_path = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f'codegen-{uid}.tar.gz'
-        )
-        make_tarball(out_path, tarball_path)
-        return FileResponse(tarball_path,
-                    filename=os.path.basename(tarball_path),
-                    media_type='application/x-tar')
+        return await archive_response(model_dec, archive, compresslevel, if_none_match,
+                                      async_actions)
+    except ExecutorBusy:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=HTTP_400_BAD_REQUEST,
@@ -226,27 +327,16 @@ async def gen_model_b64(fenc: str = '', api_key: str = Security(get_api_key)):
 
 @api.post("/generate")
 async def gen_model(input_model: TransformationModel = Body(...),
+                    archive: str = 'tar.gz',
+                    compresslevel: Optional[int] = None,
+                    async_actions: bool = False,
+                    if_none_match: Optional[str] = Header(None),
                     api_key: str = Security(get_api_key)):
     try:
-        uid = uuid.uuid4().hex[0:8]
-        fpath = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f"model_for_codegen-{uid}.dflow"
-        )
-        with open(fpath, 'w') as f:
-            f.write(input_model.model)
-        out_path = rasa_generator(
-            fpath,
-            output_path=os.path.join(CONSTANTS.TMP_DIR, f'codegen-{uid}')
-        )
-        tarball_path = os.path.join(
-            CONSTANTS.TMP_DIR,
-            f'codegen-{uid}.tar.gz'
-        )
-        make_tarball(out_path, tarball_path)
-        return FileResponse(tarball_path,
-                    filename=os.path.basename(tarball_path),
-                    media_type='application/x-tar')
+        return await archive_response(input_model.model, archive, compresslevel, if_none_match,
+                                      async_actions)
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print(f"Exception thrown in /generate: {e}")
         raise HTTPException(
@@ -254,6 +344,85 @@ async def gen_model(input_model: TransformationModel = Body(...),
             detail=f"{str(e)}",
         )
 
+def job_response(job) -> dict:
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'created_at': job.get('created_at'),
+        'started_at': job.get('started_at'),
+        'finished_at': job.get('finished_at'),
+        'error': job.get('error'),
+    }
+
+
+def get_job_or_404(job_id: str) -> dict:
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found or expired",
+        )
+    return job
+
+
+def submit_job(model_str, archive: str, compresslevel: int, async_actions: bool) -> dict:
+    try:
+        job = JOBS.submit_generate(model_str, archive, compresslevel, async_actions)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+    return job_response(job)
+
+
+@api.post("/jobs/generate", status_code=HTTP_202_ACCEPTED)
+async def submit_gen_model(input_model: TransformationModel = Body(...),
+                           archive: str = 'tar.gz',
+                           compresslevel: Optional[int] = None,
+                           async_actions: bool = False,
+                           api_key: str = Security(get_api_key)):
+    return submit_job(input_model.model, archive, compresslevel, async_actions)
+
+
+@api.post("/jobs/generate/file", status_code=HTTP_202_ACCEPTED)
+async def submit_gen_from_file(model_file: UploadFile = File(...),
+                               archive: str = 'tar.gz',
+                               compresslevel: Optional[int] = None,
+                               async_actions: bool = False,
+                               api_key: str = Security(get_api_key)):
+    return submit_job(await model_file.read(), archive, compresslevel, async_actions)
+
+
+@api.post("/jobs/generate/b64", status_code=HTTP_202_ACCEPTED)
+async def submit_gen_model_b64(fenc: str = '',
+                               archive: str = 'tar.gz',
+                               compresslevel: Optional[int] = None,
+                               async_actions: bool = False,
+                               api_key: str = Security(get_api_key)):
+    return submit_job(base64.b64decode(fenc), archive, compresslevel, async_actions)
+
+
+@api.get("/jobs/{job_id}")
+async def job_status(job_id: str, api_key: str = Security(get_api_key)):
+    return job_response(get_job_or_404(job_id))
+
+
+@api.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, api_key: str = Security(get_api_key)):
+    job = get_job_or_404(job_id)
+    if job['status'] == FAILED:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail=f"Codegen error: {job.get('error')}",
+        )
+    if job['status'] != DONE:
+        raise HTTPException(
+            status_code=HTTP_409_CONFLICT,
+            detail=f"Job {job_id} is {job['status']}",
+        )
+    return FileResponse(job['result'],
+                        filename=os.path.basename(job['result']),
+                        media_type=ARCHIVE_MEDIA_TYPES[job.get('archive', 'tar.gz')])
+
+
 @api.post("/openapi2dflow")
 async def openapi2dflow(input_model: str = Body(...),
                        api_key: str = Security(get_api_key)):
@@ -286,10 +455,12 @@ async def openapi2dflow(input_model: str = Body(...),
     #     raise HTTPException(status_code=400, detail=f"Invalid OpenAPI model: {e}")
 
     try:
-        dflow_model_str = openapi_to_dflow(model)
+        dflow_model_str = await EXECUTOR.run(openapi_to_dflow, model)
         resp['message'] = 'OpenAPI-To-dFlow Model Transformation success'
         resp['model_str'] = dflow_model_str
         return resp
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print('Exception while performing transformation')
         print(e)
@@ -327,15 +498,13 @@ async def openapi2dflow_file(model_file: UploadFile = File(...),
     #     raise HTTPException(status_code=400, detail=f"Invalid OpenAPI model: {e}")
 
     try:
-        dflow_model_str = openapi_to_dflow(model)
+        dflow_model_str = await EXECUTOR.run(openapi_to_dflow, model)
         resp['message'] = 'OpenAPI-To-dFlow Model Transformation success'
         resp['model_str'] = dflow_model_str
         return resp
+    except ExecutorBusy:
+        raise
     except Exception as e:
         print('Exception while performing transformation')
         print(e)
         raise HTTPException(status_code=400, detail=f"Transformation Failed: {e}")
-
-def make_tarball(source_dir, out_path):
-    with tarfile.open(out_path, "w:gz") as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
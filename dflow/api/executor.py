@@ -0,0 +1,86 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class ExecutorBusy(Exception):
+    """ Raised when the executor already holds as many jobs as it may queue. """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class BoundedExecutor():
+    """
+        Runs blocking calls off the event loop, on a thread or process pool.
+
+        At most `workers` calls run at once and at most `queue_size` more wait
+        for a worker. Calls beyond that are rejected with ExecutorBusy instead
+        of piling up, so the event loop keeps serving the cheap requests.
+    """
+
+    def __init__(self,
+                 kind: str = 'thread',
+                 workers: int = None,
+                 queue_size: int = None,
+                 retry_after: int = 5,
+                 initializer=None):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor kind '{kind}'. Use 'thread' or 'process'")
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = self.workers * 4 if queue_size is None else queue_size
+        self.retry_after = retry_after
+        self.initializer = initializer
+        self._pool: Executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, initializer=None) -> 'BoundedExecutor':
+        """ Builds the executor from the API_EXECUTOR* environment variables. """
+        workers = os.getenv("API_EXECUTOR_WORKERS")
+        queue_size = os.getenv("API_EXECUTOR_QUEUE_SIZE")
+        return cls(kind=os.getenv("API_EXECUTOR", "thread"),
+                   workers=int(workers) if workers else None,
+                   queue_size=int(queue_size) if queue_size else None,
+                   retry_after=int(os.getenv("API_EXECUTOR_RETRY_AFTER", 5)),
+                   initializer=initializer)
+
+    @property
+    def pending(self) -> int:
+        """ Number of running and queued calls. """
+        return self._pending
+
+    def start(self) -> None:
+        if self._pool is not None:
+            return
+        if self.kind == 'process':
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             initializer=self.initializer)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='dflow-api')
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    async def run(self, fn, *args, **kwargs):
+        """ Runs fn(*args, **kwargs) on the pool and returns its result. """
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                raise ExecutorBusy(self.retry_after)
+            self._pending += 1
+        try:
+            self.start()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._pool, functools.partial(fn, *args, **kwargs))
+        finally:
+            with self._lock:
+                self._pending -= 1
@@ -0,0 +1,206 @@
+"""
+    Background codegen jobs.
+
+    A job runs on a local process pool and keeps its state in a small JSON
+    file under the store directory, next to its result archive. Any API
+    worker process on the host can therefore answer status and result
+    requests, not only the one that accepted the job. Finished jobs and their
+    results are removed once they are older than the store's TTL.
+
+    Each job records the process that runs its pool. A job still queued or
+    running when that process is gone (e.g. after a restart) is marked as
+    failed, so that it expires like the other finished jobs.
+"""
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+from dflow.api.executor import ExecutorBusy
+from dflow.api.tasks import write_archive
+from dflow.archive import check_archive_options
+from dflow import definitions as CONSTANTS
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobStore():
+    """ Submits codegen jobs to a process pool and tracks them on disk. """
+
+    def __init__(self,
+                 root: str,
+                 ttl: int = 3600,
+                 workers: int = None,
+                 max_pending: int = None,
+                 retry_after: int = 5,
+                 initializer=None):
+        self.root = root
+        self.ttl = ttl
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = self.workers * 8 if max_pending is None else max_pending
+        self.retry_after = retry_after
+        self.initializer = initializer
+        self._pool = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, initializer=None) -> 'JobStore':
+        """ Builds the store from the JOBS_* environment variables. """
+        workers = os.getenv("JOBS_WORKERS")
+        max_pending = os.getenv("JOBS_MAX_PENDING")
+        return cls(root=os.getenv("JOBS_DIR", os.path.join(CONSTANTS.TMP_DIR, 'jobs')),
+                   ttl=int(os.getenv("JOBS_TTL", 3600)),
+                   workers=int(workers) if workers else None,
+                   max_pending=int(max_pending) if max_pending else None,
+                   retry_after=int(os.getenv("JOBS_RETRY_AFTER", 5)),
+                   initializer=initializer)
+
+    def start(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             initializer=self.initializer)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def submit_generate(self,
+                        model_str,
+                        archive_format: str = 'tar.gz',
+                        compresslevel: int = None,
+                        async_actions: bool = False) -> Dict[str, Any]:
+        """
+            Queues the generation of the Rasa sources of a model and returns
+            the job. The options are those of tasks.write_archive.
+        """
+        check_archive_options(archive_format, compresslevel)
+        options = {'archive_format': archive_format, 'async_actions': async_actions}
+        if compresslevel is not None:
+            options['compresslevel'] = compresslevel
+        self.purge()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise ExecutorBusy(self.retry_after)
+            self.start()
+            job_id = uuid.uuid4().hex
+            job = {'id': job_id, 'status': QUEUED, 'created_at': time.time(),
+                   'owner': os.getpid(), 'archive': archive_format}
+            _write_job(self.root, job)
+            future = self._pool.submit(_run_generate_job, self.root, job_id, model_str, options)
+            self._pending.add(future)
+        future.add_done_callback(lambda f: self._job_finished(job_id, f))
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ Returns the job with the given id, or None if it does not exist or expired. """
+        if not JOB_ID_RE.match(job_id):
+            return None
+        self.purge()
+        return _read_job(self.root, job_id)
+
+    def purge(self) -> None:
+        """
+            Removes the finished jobs older than the TTL, with their results,
+            and fails the jobs whose process is gone.
+        """
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        for fname in os.listdir(self.root):
+            job_id, ext = os.path.splitext(fname)
+            if ext != '.json' or not JOB_ID_RE.match(job_id):
+                continue
+            job = _read_job(self.root, job_id)
+            if job is None:
+                continue
+            if job['status'] not in (DONE, FAILED):
+                if not _process_alive(job.get('owner')):
+                    _update_job(self.root, job_id, status=FAILED,
+                                error='Job interrupted, its worker is gone', finished_at=now)
+                continue
+            if now - job.get('finished_at', now) > self.ttl:
+                _remove_job(self.root, job)
+
+    def _job_finished(self, job_id: str, future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        if future.cancelled():
+            _update_job(self.root, job_id, status=FAILED, error='Job cancelled',
+                        finished_at=time.time())
+        elif future.exception() is not None:
+            # The worker process died before it could record the outcome
+            _update_job(self.root, job_id, status=FAILED, error=str(future.exception()),
+                        finished_at=time.time())
+
+
+def _run_generate_job(root: str, job_id: str, model_str, options: Dict[str, Any]) -> None:
+    _update_job(root, job_id, status=RUNNING, started_at=time.time())
+    try:
+        result = write_archive(model_str,
+                               os.path.join(root, f"{job_id}.{options['archive_format']}"),
+                               arcname=f'codegen-{job_id}', **options)
+    except Exception as e:
+        _update_job(root, job_id, status=FAILED, error=str(e), finished_at=time.time())
+    else:
+        _update_job(root, job_id, status=DONE, result=result, finished_at=time.time())
+
+
+def _process_alive(pid) -> bool:
+    if not isinstance(pid, int):
+        # Jobs recorded without an owner can not be tracked
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _job_path(root: str, job_id: str) -> str:
+    return os.path.join(root, f'{job_id}.json')
+
+
+def _read_job(root: str, job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_job_path(root, job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_job(root: str, job: Dict[str, Any]) -> None:
+    # Write then rename, so that readers never see a partial file
+    tmp_path = f"{_job_path(root, job['id'])}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, _job_path(root, job['id']))
+
+
+def _update_job(root: str, job_id: str, **fields) -> None:
+    job = _read_job(root, job_id) or {'id': job_id}
+    job.update(fields)
+    _write_job(root, job)
+
+
+def _remove_job(root: str, job: Dict[str, Any]) -> None:
+    result = job.get('result')
+    if result and os.path.exists(result):
+        os.remove(result)
+    try:
+        os.remove(_job_path(root, job['id']))
+    except OSError:
+        pass
@@ -0,0 +1,93 @@
+"""
+    Blocking work behind the API endpoints.
+
+    These run on the API executor, possibly in another process, so they are
+    module-level functions that take and return plain values. textX errors
+    can not be pickled, so failures are re-raised as TaskError.
+
+    Imports would resolve against the server's file system, so models are
+    built as self-contained and any import is rejected once parsed.
+"""
+import functools
+import io
+import os
+
+from dflow.language import build_model_str, validation_result, merge_models as _merge_models
+from dflow.generator import codegen_archive_str
+from dflow.cache import ModelCache
+from dflow.m2m.openapi_to_dflow import openapi_to_dflow as _openapi_to_dflow
+
+# Parsed models of this process (each pool process keeps its own)
+MODEL_CACHE = ModelCache(maxsize=int(os.getenv("MODEL_CACHE_SIZE", 128)))
+
+# Default compression of the generated archives, from 0 (none) to 9
+ARCHIVE_COMPRESSLEVEL = int(os.getenv("ARCHIVE_COMPRESSLEVEL", 6))
+
+class TaskError(Exception):
+    """ Picklable error carrying the message of the original exception. """
+
+
+def _portable_errors(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            raise TaskError(str(e)) from None
+    return wrapper
+
+
+@_portable_errors
+def validate_model(model_str) -> None:
+    build_model_str(model_str, cache=MODEL_CACHE, self_contained=True)
+
+
+def validate_model_result(name: str, model_str) -> dict:
+    """ Validates a model and returns its result record (see language.validation_result). """
+    return validation_result(name, model_str, cache=MODEL_CACHE, self_contained=True)
+
+
+@_portable_errors
+def generate_archive(model_str,
+                     arcname: str,
+                     archive_format: str = 'tar.gz',
+                     compresslevel: int = ARCHIVE_COMPRESSLEVEL,
+                     async_actions: bool = False) -> bytes:
+    """ Generates the Rasa sources of a model into an in-memory archive. """
+    buffer = io.BytesIO()
+    codegen_archive_str(model_str, buffer, cache=MODEL_CACHE, self_contained=True,
+                        arcname=arcname, archive_format=archive_format,
+                        compresslevel=compresslevel, async_actions=async_actions)
+    return buffer.getvalue()
+
+
+@_portable_errors
+def write_archive(model_str,
+                  out_path: str,
+                  arcname: str,
+                  archive_format: str = 'tar.gz',
+                  compresslevel: int = ARCHIVE_COMPRESSLEVEL,
+                  async_actions: bool = False) -> str:
+    """ Generates the Rasa sources of a model into an archive file and returns its path. """
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            codegen_archive_str(model_str, f, cache=MODEL_CACHE, self_contained=True,
+                                arcname=arcname, archive_format=archive_format,
+                                compresslevel=compresslevel, async_actions=async_actions)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return out_path
+
+
+@_portable_errors
+def merge_models(models, names=None) -> str:
+    return _merge_models(models, names=names)
+
+
+@_portable_errors
+def openapi_to_dflow(model) -> str:
+    return _openapi_to_dflow(model)
+
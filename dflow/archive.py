@@ -0,0 +1,113 @@
+import io
+import tarfile
+import tempfile
+import time
+import zipfile
+from typing import Iterable
+
+ARCHIVE_FORMATS = ('tar.gz', 'tar', 'zip')
+
+ARCHIVE_MEDIA_TYPES = {
+    'tar.gz': 'application/x-tar',
+    'tar': 'application/x-tar',
+    'zip': 'application/zip',
+}
+
+# Permissions of the generated files (rwxrwxr-x), as set by the generator on disk
+FILE_MODE = 0o775
+DIR_MODE = 0o755
+
+# Bytes of a streamed tar member kept in memory before it spills to a temporary file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+def check_archive_options(archive_format: str, compresslevel: int = None) -> None:
+    """ Raises a ValueError for an unknown archive format or a compresslevel outside 0-9. """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(
+            f"Unknown archive format '{archive_format}'. Use one of {', '.join(ARCHIVE_FORMATS)}")
+    if compresslevel is not None and not 0 <= compresslevel <= 9:
+        raise ValueError("compresslevel must be between 0 and 9")
+
+
+class ArchiveWriter():
+    """
+        Writes in-memory files into a tar, tar.gz or zip archive on a file
+        object. compresslevel goes from 0 (store only) to 9 and does not
+        apply to plain tar.
+    """
+
+    def __init__(self, fileobj, archive_format: str = 'tar.gz', compresslevel: int = 6):
+        check_archive_options(archive_format, compresslevel)
+        self.archive_format = archive_format
+        self.mtime = time.time()
+        if archive_format == 'zip':
+            if compresslevel:
+                self._archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED,
+                                                compresslevel=compresslevel)
+            else:
+                self._archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_STORED)
+        elif archive_format == 'tar.gz':
+            self._archive = tarfile.open(fileobj=fileobj, mode='w:gz',
+                                         compresslevel=compresslevel)
+        else:
+            self._archive = tarfile.open(fileobj=fileobj, mode='w')
+
+    def add_dir(self, name: str) -> None:
+        name = name.rstrip('/')
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(f"{name}/", time.localtime(self.mtime)[:6])
+            info.external_attr = (0o40000 | DIR_MODE) << 16
+            self._archive.writestr(info, b'')
+        else:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = DIR_MODE
+            info.mtime = self.mtime
+            self._archive.addfile(info)
+
+    def add_file(self, name: str, content: bytes) -> None:
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.external_attr = (0o100000 | FILE_MODE) << 16
+            info.compress_type = self._archive.compression
+            self._archive.writestr(info, content)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = FILE_MODE
+            info.mtime = self.mtime
+            self._archive.addfile(info, io.BytesIO(content))
+
+    def add_stream(self, name: str, chunks: Iterable[str]) -> None:
+        """
+            Adds a file from text chunks (e.g. a streamed template) without
+            joining them first. Zip members are written as the chunks come;
+            a tar member needs its size up front, so its chunks are spooled.
+        """
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.external_attr = (0o100000 | FILE_MODE) << 16
+            info.compress_type = self._archive.compression
+            with self._archive.open(info, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk.encode('utf-8'))
+            return
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            for chunk in chunks:
+                spool.write(chunk.encode('utf-8'))
+            info = tarfile.TarInfo(name)
+            info.size = spool.tell()
+            info.mode = FILE_MODE
+            info.mtime = self.mtime
+            spool.seek(0)
+            self._archive.addfile(info, spool)
+
+    def close(self) -> None:
+        self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
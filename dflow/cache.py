@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from os.path import abspath, dirname, join
+
+from dflow import __version__
+from dflow.utils import grammar_checksum, templates_checksum, validator_checksum
+
+
+class LRUCache():
+    """ Thread-safe in-memory mapping that evicts the least recently used entries. """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class ModelCache():
+    """
+        Cache of parsed dFlow models, addressed by the hash of the model text,
+        the dFlow version and the grammar and validator code.
+
+        The in-memory tier keeps the model objects themselves. textX models
+        can not be pickled, so the optional on-disk tier (cache_dir) only
+        remembers which model texts passed semantic validation. A disk hit
+        answers validation without parsing; building the model still
+        parses it, but skips validation.
+    """
+
+    def __init__(self, maxsize: int = 128, cache_dir: str = None):
+        self.models = LRUCache(maxsize)
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, model_str: str, file_name: str = None, variant: str = '') -> str:
+        """
+            Builds the cache key of a model. Imports resolve relative to the
+            model's directory, so the directory is part of the key. variant
+            tells apart the builds of the same text with other options
+            (e.g. debug).
+        """
+        digest = hashlib.sha256()
+        digest.update(__version__.encode('utf-8'))
+        digest.update(grammar_checksum().encode('utf-8'))
+        digest.update(validator_checksum().encode('utf-8'))
+        digest.update(variant.encode('utf-8'))
+        if file_name:
+            digest.update(dirname(abspath(file_name)).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(model_str.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        return self.models.get(key)
+
+    def put(self, key, model, validated: bool = True) -> None:
+        self.models.put(key, model)
+        if validated and self.cache_dir:
+            open(self._verdict_path(key), 'a').close()
+
+    def is_validated(self, key) -> bool:
+        """ Returns whether the model with the given key passed validation before. """
+        if key in self.models:
+            return True
+        return bool(self.cache_dir) and os.path.exists(self._verdict_path(key))
+
+    def clear(self) -> None:
+        self.models.clear()
+
+    def _verdict_path(self, key) -> str:
+        return join(self.cache_dir, f"{key}.valid")
+
+
+class ResultCache():
+    """
+        In-memory LRU cache of generated archives, bounded both by the number
+        of entries and by their total size in bytes.
+
+        Keys cover the model text, the dFlow version, the grammar and
+        templates, and the generation options, so a key identifies the
+        generated output and doubles as its ETag.
+    """
+
+    def __init__(self, maxsize: int = 256, max_bytes: int = 256 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, model_str, **options) -> str:
+        if isinstance(model_str, str):
+            model_str = model_str.encode('utf-8')
+        digest = hashlib.sha256()
+        digest.update(__version__.encode('utf-8'))
+        digest.update(grammar_checksum().encode('utf-8'))
+        digest.update(templates_checksum().encode('utf-8'))
+        digest.update(repr(sorted(options.items())).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(model_str)
+        return digest.hexdigest()
+
+    def get(self, key) -> bytes:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= len(self._entries.pop(key))
+            self._entries[key] = content
+            self.nbytes += len(content)
+            while len(self._entries) > self.maxsize or self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class ResponseCache():
+    """
+        Persistent cache of text responses (e.g. of the LLM service), one JSON
+        file per entry under cache_dir. Keys are digests of the request fields,
+        so the same request is answered from disk on later runs.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, **fields) -> str:
+        payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key) -> str:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)['response']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, response: str) -> None:
+        # Write then rename, so that concurrent readers never see a partial file
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'response': response}, f)
+        os.replace(tmp_path, self._path(key))
+
+    def clear(self) -> None:
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.json'):
+                os.remove(join(self.cache_dir, fname))
+
+    def _path(self, key) -> str:
+        return join(self.cache_dir, f"{key}.json")
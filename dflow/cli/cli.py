@@ -1,10 +1,16 @@
 import click
+import glob
 import os
 from rich import print, pretty
 import json
 
-from dflow.language import build_model, report_model_info, merge_models
-from dflow.generator import codegen as rasa_generator
+from dflow.language import (
+    build_model, report_model_info, merge_models, validate_models, MergeConflictError
+)
+from dflow.generator import codegen as rasa_generator, codegen_many
+from dflow.cache import ModelCache
+from dflow.utils import precompile_templates
+from dflow import definitions as CONSTANTS
 
 pretty.install()
 
@@ -23,24 +29,98 @@ def cli(ctx):
 
 @cli.command("validate", help="Model Validation")
 @click.pass_context
-@click.argument("model_path")
-def validate(ctx, model_path):
-    model = build_model(model_path)
-    print("[*] Model validation success!!")
-    report_model_info(model)
+@click.argument("model_paths", nargs=-1, required=True)
+@click.option("--cache/--no-cache", default=False,
+              help=f"Remember the models that passed validation in {CONSTANTS.CACHE_DIR}, "
+                   "so that they are only parsed again, not validated")
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of worker processes when validating many models")
+def validate(ctx, model_paths, cache, jobs):
+    if len(model_paths) == 1 and not os.path.isdir(model_paths[0]):
+        model_cache = ModelCache(cache_dir=CONSTANTS.CACHE_DIR) if cache else None
+        model = build_model(model_paths[0], cache=model_cache)
+        print("[*] Model validation success!!")
+        report_model_info(model)
+        return
+
+    models = find_models(model_paths)
+    cache_dir = CONSTANTS.CACHE_DIR if cache else None
+    for result in validate_models(models, jobs=jobs, cache_dir=cache_dir):
+        if 'summary' in result:
+            summary = result['summary']
+            print(f"[*] Validated {summary['total']} models in {summary['duration']}s "
+                  f"({summary['jobs']} jobs): {summary['valid']} valid, {summary['invalid']} invalid")
+        elif result['valid']:
+            print(f"[*] {result['model']}: OK ({result['duration']}s)")
+        else:
+            print(f"[X] {result['model']}: {result['error']}")
+    if summary['invalid']:
+        ctx.exit(1)
+
+
+def find_models(paths):
+    """ Expands directories and glob patterns into the .dflow models they contain. """
+    models = []
+    for path in paths:
+        if any(c in path for c in '*?['):
+            models.extend(sorted(glob.glob(path, recursive=True)))
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                models.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.dflow'))
+        else:
+            models.append(path)
+    return models
 
 
 @cli.command("gen", help="M2T/M2M transformations")
 @click.pass_context
-@click.argument("model_path")
+@click.argument("model_paths", nargs=-1, required=True)
 @click.argument("generator")
-def generate(ctx, model_path, generator):
+@click.option("--max-intent-examples", type=click.IntRange(min=1), default=None,
+              help="Cap on the training examples generated per intent")
+@click.option("--render-workers", type=int, default=1,
+              help="Number of templates rendered concurrently")
+@click.option("--render-executor", type=click.Choice(["thread", "process"]),
+              default="thread", help="Pool used when rendering concurrently")
+@click.option("--incremental/--no-incremental", default=False,
+              help="Only rewrite the artifacts whose inputs changed since the last run")
+@click.option("--async-actions/--no-async-actions", default=False,
+              help="Generate async actions that call services with httpx")
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of worker processes when generating many models")
+@click.option("-o", "--output-dir", default=None,
+              help="Parent directory of the per-model outputs when generating many models")
+def generate(ctx, model_paths, generator, max_intent_examples,
+             render_workers, render_executor, incremental, async_actions, jobs, output_dir):
     if generator not in ("rasa"):
         print(f"[*] Generator {generator} not supported")
         return
-    if generator == "rasa":
-        out_path = rasa_generator(model_path)
-    print(f"[*] M2T finished. Output: {out_path}")
+    custom_args = {
+        'max_intent_examples': max_intent_examples,
+        'render_workers': render_workers,
+        'render_executor': render_executor,
+        'incremental': incremental,
+        'async_actions': async_actions
+    }
+    if len(model_paths) == 1 and not os.path.isdir(model_paths[0]) and output_dir is None:
+        out_path = rasa_generator(model_paths[0], **custom_args)
+        print(f"[*] M2T finished. Output: {out_path}")
+        return
+
+    models = find_models(model_paths)
+    for result in codegen_many(models, output_dir=output_dir, jobs=jobs, **custom_args):
+        if 'summary' in result:
+            summary = result['summary']
+            print(f"[*] Generated {summary['succeeded']}/{summary['total']} models in "
+                  f"{summary['duration']}s ({summary['jobs']} jobs), {summary['size']} bytes")
+        elif result['error'] is None:
+            print(f"[*] {result['model']} -> {result['output']} "
+                  f"({result['duration']}s, {result['size']} bytes)")
+        else:
+            print(f"[X] {result['model']}: {result['error']}")
+    if summary['failed']:
+        ctx.exit(1)
 
 @cli.command("merge", help="Merge Models")
 @click.pass_context
@@ -50,11 +130,23 @@ def merge(ctx, models):
     if len(_models) < 2:
         print("[X] Number of models must be greater than two (2)")
         return
-    merged_model_str = merge_models(_models)
+    try:
+        merged_model_str = merge_models(_models, names=[model.name for model in models])
+    except MergeConflictError as e:
+        print("[X] Models can not be merged:")
+        for collision in e.collisions:
+            print(f"    {collision}")
+        ctx.exit(1)
     out_path = f"merged.dflow"
     with open(out_path, 'w') as f:
                 f.write(merged_model_str)
     print(f"[*] Model merging finished - Output: {out_path}")
 
+@cli.command("precompile", help="Precompile the code generation templates")
+@click.pass_context
+def precompile(ctx):
+    count = precompile_templates()
+    print(f"[*] Compiled {count} templates into {CONSTANTS.CACHE_DIR}")
+
 def main():
     cli(prog_name="dflow")
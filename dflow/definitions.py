@@ -1,4 +1,5 @@
-from os.path import dirname, join
+import os
+from os.path import dirname, join, expanduser
 
 
 THIS_DIR = dirname(__file__)
@@ -6,6 +7,7 @@ TEMPLATES_PATH = join(THIS_DIR, "templates")
 MODEL_REPO_PATH = None
 BUILTIN_MODELS = None
 TMP_DIR = "/tmp/dflow"
+CACHE_DIR = os.getenv("DFLOW_CACHE_DIR", join(expanduser("~"), ".cache", "dflow"))
 PE_CLASSES_LIST = [
     'PERSON',
     'NORP',
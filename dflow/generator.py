@@ -1,27 +1,37 @@
 from os import path, mkdir, chmod, getcwd
 from textx import generator, metamodel_from_file
-import jinja2, argparse, itertools, shutil, re
+import jinja2, argparse, itertools, shutil, re, math, random, hashlib, time
+import jinja2.meta
 from itertools import groupby
 from operator import itemgetter
 
 import textx.scoping.providers as scoping_providers
 from rich import print
-from pydantic import BaseModel
-from typing import Any, List, Dict, Set
+from pydantic import BaseModel, Field
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import Any, List, Dict, Set, Iterator
 
-from dflow.utils import get_mm, build_model
+from dflow.utils import get_mm, build_model, build_model_str, get_jinja_env, is_set, GENERATOR_JINJA_OPTIONS
+from dflow.model_index import get_model_index
+from dflow.archive import ArchiveWriter
 
 import json, os
 
 ALL_ACTIONS = 'all_actions'
 
+# Seconds the generated actions wait for an EService that sets no timeout
+ESERVICE_DEFAULT_TIMEOUT = 10
+
+# Responses kept by an EService cache that sets no cache_size
+ESERVICE_DEFAULT_CACHE_SIZE = 256
+
+# Seconds the generated actions remember a third-party identity, when the model sets no cache_ttl
+AUTH_DEFAULT_CACHE_TTL = 300
+
 _THIS_DIR = path.abspath(path.dirname(__file__))
 
 # Initialize template engine.
-jinja_env = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(path.join(_THIS_DIR, 'templates')),
-    trim_blocks=True,
-    lstrip_blocks=True)
+jinja_env = get_jinja_env(**GENERATOR_JINJA_OPTIONS)
 
 SRC_GEN_DIR = path.join(path.realpath(getcwd()), 'gen')
 
@@ -38,6 +48,15 @@ STATIC_TEMPLATES = [
     'endpoints.yml'
 ]
 
+# Archive directory of the files a model places outside the generated sources (absolute paths)
+ARCHIVE_EXTERNAL_DIR = 'external'
+
+# Fingerprints of the generated artifacts, kept in the output directory by incremental runs
+MANIFEST_FILE = '.dflow-manifest.json'
+
+# Variables read by each template, keyed by template name and source
+_TEMPLATE_VARIABLES = {}
+
 
 class AccessControlMisc():
     policy_path: str = ''
@@ -47,6 +66,16 @@ class AccessControlMisc():
     global_ac: bool = False # True if global(actionGroup) access control is defined
     local_ac: bool = False # True if local(action) access control is defined
 
+    def __init__(self):
+        # Per-instance state, so that consecutive generations do not leak
+        # roles/authentication into each other and the object can be pickled.
+        self.policy_path = ''
+        self.default_role = ''
+        self.role_users = {}
+        self.authentication = {}
+        self.global_ac = False
+        self.local_ac = False
+
 
 class TransformationDataModel(BaseModel):
     synonyms: List[Dict[str, Any]] = []
@@ -64,8 +93,9 @@ class TransformationDataModel(BaseModel):
     responses: List[Dict[str, Any]] = []
     roles: List[str] = []
     policies: Dict[str, set] = {}
-    ac_misc: AccessControlMisc = AccessControlMisc()
+    ac_misc: AccessControlMisc = Field(default_factory=AccessControlMisc)
     nlu_config: Dict[str, str] = {}
+    files: Dict[str, str] = {} # Generated files besides the templates, by path relative to the output
 
     class Config:
             arbitrary_types_allowed = True
@@ -74,13 +104,125 @@ def codegen(model_fillepath,
             output_path=None,
             overwrite=False,
             debug=True,
+            cache=None,
              **custom_args):
     metamodel = get_mm()
-    model, _ = build_model(model_fillepath)
+    model, _ = build_model(model_fillepath, cache=cache)
+    return generate(metamodel, model, output_path,
+                    overwrite, debug, **custom_args)
+
+
+def codegen_str(model_str,
+                output_path=None,
+                overwrite=False,
+                debug=True,
+                cache=None,
+                **custom_args):
+    """ Same as codegen, but for a model given as a string (or utf-8 bytes). """
+    metamodel = get_mm()
+    model, _ = build_model_str(model_str, cache=cache)
     return generate(metamodel, model, output_path,
                     overwrite, debug, **custom_args)
 
 
+def codegen_archive_str(model_str,
+                        fileobj,
+                        cache=None,
+                        self_contained=False,
+                        **custom_args):
+    """ Same as codegen_str, but generates into an archive written to fileobj (see generate_archive). """
+    model, _ = build_model_str(model_str, cache=cache, self_contained=self_contained)
+    generate_archive(model, fileobj, **custom_args)
+
+
+def codegen_many(model_paths: List[str],
+                 output_dir: str = None,
+                 jobs: int = None,
+                 **custom_args) -> Iterator[Dict[str, Any]]:
+    """
+        Generates the Rasa sources of many models on a process pool. Every
+        worker loads the metamodel and templates once and reuses them for all
+        the models it gets. Each model is generated into its own directory
+        under output_dir, named after the model file.
+
+        Yields the result of each model as it finishes, followed by a summary
+        dict with the aggregate counts, size and timing.
+    """
+    start = time.perf_counter()
+    output_dir = output_dir or SRC_GEN_DIR
+    out_dirs = model_output_dirs(model_paths, output_dir)
+    jobs = jobs or os.cpu_count() or 1
+    if not path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    pool = None
+    if jobs == 1 or len(model_paths) <= 1:
+        results = (_codegen_in_worker(m, out_dirs[m], custom_args) for m in model_paths)
+    else:
+        pool = ProcessPoolExecutor(max_workers=min(jobs, len(model_paths)),
+                                   initializer=warm_generator)
+        futures = [pool.submit(_codegen_in_worker, m, out_dirs[m], custom_args)
+                   for m in model_paths]
+        results = (f.result() for f in as_completed(futures))
+
+    succeeded, size = 0, 0
+    try:
+        for result in results:
+            succeeded += result['error'] is None
+            size += result['size']
+            yield result
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    yield {
+        'summary': {
+            'total': len(model_paths),
+            'succeeded': succeeded,
+            'failed': len(model_paths) - succeeded,
+            'size': size,
+            'jobs': jobs,
+            'duration': round(time.perf_counter() - start, 4)
+        }
+    }
+
+
+def model_output_dirs(model_paths: List[str], output_dir: str) -> Dict[str, str]:
+    """ Names the output directory of each model after its file, numbering duplicates. """
+    out_dirs, seen = {}, {}
+    for model_path in model_paths:
+        name = path.splitext(path.basename(model_path))[0]
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            name = f"{name}-{seen[name]}"
+        out_dirs[model_path] = path.join(output_dir, name)
+    return out_dirs
+
+
+def warm_generator() -> None:
+    """ Loads the metamodel and the templates, e.g. when a worker process starts. """
+    get_mm()
+    for file in TEMPLATES:
+        jinja_env.get_template(file)
+
+
+def _codegen_in_worker(model_path: str, out_dir: str, custom_args: Dict[str, Any]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    error, size = None, 0
+    try:
+        codegen(model_path, output_path=out_dir, **custom_args)
+        for root, _, files in os.walk(out_dir):
+            size += sum(path.getsize(path.join(root, f)) for f in files)
+    except Exception as e:
+        error = str(e)
+    return {
+        'model': model_path,
+        'output': out_dir,
+        'error': error,
+        'size': size,
+        'duration': round(time.perf_counter() - start, 4)
+    }
+
+
 @generator('dflow', 'rasa')
 def dflow_generate_rasa(metamodel,
                         model,
@@ -116,46 +258,232 @@ def generate(metamodel,
     if not path.exists(path.join(out_dir, 'models')):
         mkdir(path.join(out_dir, 'models'))
 
-    data = parse_model(model, out_dir)
+    data = parse_model(model, out_dir, max_intent_examples=get_max_intent_examples(custom_args))
 
     # Generate
-    for file in TEMPLATES:
-        gen_file_name = path.splitext(file)[0]
-
-        out_file = path.join(out_dir, gen_file_name)
-        template = jinja_env.get_template(file)
-        with open(path.join(out_file), 'w') as f:
-            f.write(template.render(
-                intents=data.intents,
-                synonyms=data.synonyms,
-                pretrained_entities=data.pretrained_entities,
-                entities=data.entities,
-                events=data.events,
-                eservices=data.eservices,
-                stories=data.stories,
-                actions=data.actions,
-                rules=data.rules,
-                slots=data.slots,
-                forms=data.forms,
-                responses=data.responses,
-                connectors=data.connectors,
-                roles=data.roles,
-                policies=data.policies,
-                ac_misc=data.ac_misc,
-                nlu_config=data.nlu_config
-            )
-        )
-        chmod(out_file, 509)
+    context = template_context(data, async_actions=bool(custom_args.get('async_actions', False)))
+    incremental = bool(custom_args.get('incremental', False))
+    fingerprints = {}
+    if incremental:
+        manifest = load_manifest(out_dir)
+        templates = []
+        for file in TEMPLATES:
+            fingerprints[file] = template_fingerprint(file, context)
+            if not is_up_to_date(out_dir, file, fingerprints[file], manifest):
+                templates.append(file)
+    else:
+        # The artifacts are rewritten regardless, so a manifest left by an
+        # earlier incremental run would no longer describe them
+        remove_manifest(out_dir)
+        templates = TEMPLATES
+
+    render_workers = int(custom_args.get('render_workers') or 1)
+    if render_workers > 1:
+        render_templates_parallel(templates, context, out_dir, render_workers,
+                                  custom_args.get('render_executor', 'thread'))
+    else:
+        for file in templates:
+            render_template(file, context, out_dir)
 
     for file in STATIC_TEMPLATES:
         out_file = path.join(out_dir, file)
         template = path.join(path.join(_THIS_DIR, 'templates', file))
+        if incremental:
+            with open(template, 'rb') as f:
+                fingerprints[file] = hashlib.sha256(f.read()).hexdigest()
+            if is_up_to_date(out_dir, file, fingerprints[file], manifest):
+                continue
         shutil.copyfile(template, out_file)
         chmod(out_file, 509)
 
+    for file, content in data.files.items():
+        write_file(out_dir, file, content)
+
+    if incremental:
+        save_manifest(out_dir, fingerprints)
+        if debug:
+            print(f"Incremental codegen: rewrote {len(templates)} of {len(TEMPLATES)} templates")
+
     return out_dir
 
 
+def generate_archive(model,
+                     fileobj,
+                     arcname: str = 'codegen',
+                     archive_format: str = 'tar.gz',
+                     compresslevel: int = 6,
+                     **custom_args) -> None:
+    """
+        Generates the Rasa sources of a model straight into an archive written
+        to fileobj, under the arcname directory, without an output directory
+        on disk. archive_format is one of ARCHIVE_FORMATS and compresslevel
+        goes from 0 (no compression) to 9.
+
+        Files the model places at absolute paths (e.g. user-role mappings)
+        are not written to this host either. They go under
+        ARCHIVE_EXTERNAL_DIR, at their absolute path, to be deployed with
+        the bot.
+    """
+    # Relative policy paths stay relative to the root of the generated sources
+    data = parse_model(model, '', max_intent_examples=get_max_intent_examples(custom_args))
+    context = template_context(data, async_actions=bool(custom_args.get('async_actions', False)))
+
+    with ArchiveWriter(fileobj, archive_format, compresslevel) as archive:
+        for directory in ('', 'actions', 'data', 'models'):
+            archive.add_dir(path.join(arcname, directory))
+        for file in TEMPLATES:
+            template = jinja_env.get_template(file)
+            archive.add_stream(path.join(arcname, path.splitext(file)[0]),
+                               template.generate(**context))
+        for file in STATIC_TEMPLATES:
+            with open(path.join(_THIS_DIR, 'templates', file), 'rb') as f:
+                archive.add_file(path.join(arcname, file), f.read())
+        for file, content in data.files.items():
+            if path.isabs(file):
+                file = path.join(ARCHIVE_EXTERNAL_DIR, path.relpath(file, '/'))
+            archive.add_file(path.join(arcname, file), content.encode('utf-8'))
+
+
+def get_max_intent_examples(custom_args: Dict[str, Any]) -> int:
+    max_intent_examples = custom_args.get('max_intent_examples')
+    if max_intent_examples is not None:
+        max_intent_examples = int(max_intent_examples)
+        if max_intent_examples < 1:
+            raise ValueError(f"max_intent_examples must be a positive number, got {max_intent_examples}")
+    return max_intent_examples
+
+
+def write_file(out_dir: str, file: str, content: str) -> None:
+    """ Writes a generated file, creating its directory if needed. """
+    out_file = path.join(out_dir, file)
+    directory = path.dirname(out_file)
+    if directory and not path.exists(directory):
+        os.makedirs(directory)
+    with open(out_file, 'w') as f:
+        f.write(content)
+
+
+def template_context(data: TransformationDataModel, async_actions: bool = False) -> Dict[str, Any]:
+    """
+        Returns the variables the templates are rendered with. async_actions
+        emits async actions and form validators, calling services with httpx.
+    """
+    return {
+        'intents': data.intents,
+        'synonyms': data.synonyms,
+        'pretrained_entities': data.pretrained_entities,
+        'entities': data.entities,
+        'events': data.events,
+        'eservices': data.eservices,
+        'stories': data.stories,
+        'actions': data.actions,
+        'rules': data.rules,
+        'slots': data.slots,
+        'forms': data.forms,
+        'responses': data.responses,
+        'connectors': data.connectors,
+        'roles': data.roles,
+        'policies': data.policies,
+        'ac_misc': data.ac_misc,
+        'nlu_config': data.nlu_config,
+        'async_actions': async_actions
+    }
+
+
+def render_template(file: str, context: Dict[str, Any], out_dir: str) -> str:
+    """ Renders a dynamic template into out_dir and returns the generated file path. """
+    out_file = path.join(out_dir, path.splitext(file)[0])
+    template = jinja_env.get_template(file)
+    # Stream the output to the file, instead of rendering it into memory first
+    with open(out_file, 'w') as f:
+        template.stream(**context).dump(f)
+    chmod(out_file, 509)
+    return out_file
+
+
+def render_templates_parallel(files: List[str],
+                              context: Dict[str, Any],
+                              out_dir: str,
+                              workers: int,
+                              executor: str = 'thread') -> List[str]:
+    """
+        Renders the given dynamic templates concurrently. Templates do not depend
+        on each other, so each one is written as soon as it is rendered.
+        executor is either 'thread' or 'process'; the process pool pickles the
+        template context for each worker.
+    """
+    if executor == 'thread':
+        pool_cls = ThreadPoolExecutor
+    elif executor == 'process':
+        pool_cls = ProcessPoolExecutor
+    else:
+        raise ValueError(f"Unknown render executor '{executor}'. Use 'thread' or 'process'")
+    out_files = []
+    if not files:
+        return out_files
+    with pool_cls(max_workers=min(workers, len(files))) as pool:
+        futures = [pool.submit(render_template, file, context, out_dir) for file in files]
+        for future in as_completed(futures):
+            out_files.append(future.result())
+    return out_files
+
+
+def template_variables(file: str) -> Set[str]:
+    """ Returns the (undeclared) variables a template reads, i.e. its inputs. """
+    source, _, _ = jinja_env.loader.get_source(jinja_env, file)
+    variables = _TEMPLATE_VARIABLES.get((file, source))
+    if variables is None:
+        variables = jinja2.meta.find_undeclared_variables(jinja_env.parse(source))
+        _TEMPLATE_VARIABLES[(file, source)] = variables
+    return variables
+
+
+def template_fingerprint(file: str, context: Dict[str, Any]) -> str:
+    """
+        Fingerprints the inputs of a generated artifact: the template source
+        and the context values the template reads.
+    """
+    source, _, _ = jinja_env.loader.get_source(jinja_env, file)
+    inputs = {name: context[name] for name in sorted(template_variables(file)) if name in context}
+    digest = hashlib.sha256()
+    digest.update(source.encode('utf-8'))
+    digest.update(json.dumps(inputs, sort_keys=True, default=_fingerprint_default).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _fingerprint_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=repr)
+    return vars(obj)
+
+
+def load_manifest(out_dir: str) -> Dict[str, str]:
+    """ Returns the artifact fingerprints of the last incremental run in out_dir. """
+    try:
+        with open(path.join(out_dir, MANIFEST_FILE)) as f:
+            return json.load(f).get('artifacts', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(out_dir: str, fingerprints: Dict[str, str]) -> None:
+    with open(path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'artifacts': fingerprints}, f, indent=2, sort_keys=True)
+
+
+def remove_manifest(out_dir: str) -> None:
+    try:
+        os.remove(path.join(out_dir, MANIFEST_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def is_up_to_date(out_dir: str, file: str, fingerprint: str, manifest: Dict[str, str]) -> bool:
+    """ Whether the artifact of file exists in out_dir and was generated from the same inputs. """
+    out_file = path.join(out_dir, path.splitext(file)[0] if file in TEMPLATES else file)
+    return manifest.get(file) == fingerprint and path.exists(out_file)
+
+
 def add_static_scenario(data: TransformationDataModel) -> TransformationDataModel:
     """ Adds a vanilla bot challenge scenario (intent and dialogue) to a provided model. """
 
@@ -204,8 +532,9 @@ def add_static_scenario(data: TransformationDataModel) -> TransformationDataMode
     
     return data
 
-def parse_model(model, out_dir) -> TransformationDataModel:
+def parse_model(model, out_dir, max_intent_examples: int = None) -> TransformationDataModel:
     data = TransformationDataModel()
+    index = get_model_index(model)
     
     data = add_static_scenario(data)
 
@@ -215,7 +544,7 @@ def parse_model(model, out_dir) -> TransformationDataModel:
 
     # Extract synonyms
     synonyms_dictionary = {}
-    for synonym in model.synonyms:
+    for synonym in index.of_type('Synonym'):
         data.synonyms.append({'name': synonym.name, 'words': synonym.words})
         synonyms_dictionary[synonym.name] = synonym.words
         if not len(synonym.words):
@@ -223,37 +552,33 @@ def parse_model(model, out_dir) -> TransformationDataModel:
 
     # Extract trainable entities
     entities_dictionary = {}
-    for entity in model.entities:
-        if entity.__class__.__name__ == 'PretrainedEntity':
-            pass
-        else:
-            data.entities.append({'name': entity.name, 'words': entity.words})
-            entities_dictionary[entity.name] = entity.words
-            if not len(entity.words):
-                raise Exception(f'No examples given for entity {entity.name}')
+    for entity in index.of_type('TrainableEntity'):
+        data.entities.append({'name': entity.name, 'words': entity.words})
+        entities_dictionary[entity.name] = entity.words
+        if not len(entity.words):
+            raise Exception(f'No examples given for entity {entity.name}')
 
     # Extract pretrained entities with examples
     pretrained_entities_examples = {}
-    for trigger in model.triggers:
-        if trigger.__class__.__name__ == 'Intent':
-            for complex_phrase in trigger.phrases:
-                for phrase in complex_phrase.phrases:
-                    if phrase.__class__.__name__ == "PretrainedEntityRef":
-                        name = phrase.entity
-                        if name not in data.pretrained_entities:
-                            data.pretrained_entities.append(name)
-                        if name not in pretrained_entities_examples:
-                            pretrained_entities_examples[name] = []
-                        if phrase.refPreValues != []:
-                            pretrained_entities_examples[name].extend(phrase.refPreValues)
+    for intent in index.of_type('Intent'):
+        for complex_phrase in intent.phrases:
+            for phrase in complex_phrase.phrases:
+                if phrase.__class__.__name__ == "PretrainedEntityRef":
+                    name = phrase.entity
+                    if name not in data.pretrained_entities:
+                        data.pretrained_entities.append(name)
+                    if name not in pretrained_entities_examples:
+                        pretrained_entities_examples[name] = []
+                    if phrase.refPreValues != []:
+                        pretrained_entities_examples[name].extend(phrase.refPreValues)
 
     for key, values in pretrained_entities_examples.items():
-        pretrained_entities_examples[key] = list(set(values))
-        if not len(list(set(values))):
+        pretrained_entities_examples[key] = unique(values)
+        if not len(unique(values)):
             print(f'WARNING: No example given in Pretrained Entity {key}')
 
     # Extract external services
-    for service in model.eservices:
+    for service in index.of_type('EServiceDefHTTP'):
         service_info = {}
         service_info['verb'] = service.verb
         service_info['host'] = service.host
@@ -275,12 +600,26 @@ def parse_model(model, out_dir) -> TransformationDataModel:
             
         service_info['path'] = service.path
         service_info['url'] = f"{service_info['host']}{port}{service_info['path']}"
+        # Defaults apply only to attributes the model leaves out, an explicit 0 is an error
+        if is_set(service, 'timeout') and service.timeout <= 0:
+            raise Exception(f'EService {service.name} timeout must be a positive number of seconds!')
+        if is_set(service, 'cache_size') and service.cache_size <= 0:
+            raise Exception(f'EService {service.name} cache_size must be a positive number of responses!')
+        service_info['timeout'] = service.timeout if is_set(service, 'timeout') else ESERVICE_DEFAULT_TIMEOUT
+        service_info['retries'] = service.retries
+        service_info['cache'] = None
+        if service.cache_ttl:
+            service_info['cache'] = {
+                'ttl': service.cache_ttl,
+                'size': service.cache_size if is_set(service, 'cache_size') else ESERVICE_DEFAULT_CACHE_SIZE,
+                'backend': service.cache_backend or 'memory'
+            }
         data.eservices[service.name] = service_info
 
     # Extract triggers
-    for trigger in model.triggers:
+    for trigger in index.section('triggers'):
         if trigger.__class__.__name__ == 'Intent':
-            examples = []
+            phrases = []
             for complex_phrase in trigger.phrases:
                 text = []
                 for phrase in complex_phrase.phrases:
@@ -300,9 +639,9 @@ def parse_model(model, out_dir) -> TransformationDataModel:
                         name = phrase.entity
                         if pretrained_entities_examples[name] != []:
                             text.append(pretrained_entities_examples[name])
-                example = [' '.join(sentence) for sentence in itertools.product(*text)]
-                examples.extend(example)
-            data.intents.append({'name': trigger.name, 'examples': list(set(examples))})
+                phrases.append(text)
+            examples = expand_intent_examples(trigger.name, phrases, max_intent_examples)
+            data.intents.append({'name': trigger.name, 'examples': examples})
         else:
             data.events.append({'name': trigger.name, 'uri': trigger.uri})
 
@@ -312,7 +651,7 @@ def parse_model(model, out_dir) -> TransformationDataModel:
             raise Exception(f'Only {len(intent["examples"])} given in intent {intent["name"]}! At least 2 are needed!')
 
     # Add global slots
-    for slot in model.gslots:
+    for slot in index.section('gslots'):
         data.slots.append({'name': slot.name, 'type': 'any', 'default': slot.default, 'extract_methods': None})
 
     # Validate non duplicate dialogue names
@@ -339,7 +678,7 @@ def parse_model(model, out_dir) -> TransformationDataModel:
                 for action in response.actions:
                     roles = []
                     if action.roles:
-                        roles = list(set(action.roles))
+                        roles = unique(action.roles)
                         action_local_ac = True
                         data.ac_misc.local_ac = True # Local access control is defined
                     if action.__class__.__name__ == 'SpeakAction':
@@ -406,12 +745,16 @@ def parse_model(model, out_dir) -> TransformationDataModel:
                             'type': action.__class__.__name__,
                             'verb': action.eserviceRef.verb.lower(),
                             'url': data.eservices[action.eserviceRef.name]['url'],
+                            'timeout': data.eservices[action.eserviceRef.name]['timeout'],
+                            'retries': data.eservices[action.eserviceRef.name]['retries'],
+                            'service': action.eserviceRef.name,
+                            'cache': data.eservices[action.eserviceRef.name]['cache'] is not None,
                             'query_params': query_params,
                             'path_params': path_params,
                             'header_params': header_params,
                             'body_params': body_params,
                             'response_filter': action.response_filter,
-                            'system_properties': list(set(path_system_properties+query_system_properties+header_system_properties+body_system_properties)),
+                            'system_properties': unique(path_system_properties+query_system_properties+header_system_properties+body_system_properties),
                             'roles': roles
                         })
                 # Validate action before appending it to data object
@@ -425,9 +768,9 @@ def parse_model(model, out_dir) -> TransformationDataModel:
                             raise Exception(f'Action Group {action_group["name"]} defined twice with different actions!')
                 # Merge slots/entities etc before appending
                 if validation:
-                    actions_slots = list(set(actions_slots))
-                    actions_user_properties = list(set(actions_user_properties))
-                    actions_entities = list(set(actions_entities))
+                    actions_slots = unique(actions_slots)
+                    actions_user_properties = unique(actions_user_properties)
+                    actions_entities = unique(actions_entities)
                     data.actions.append({
                         "name": f"action_{response.name}",
                         "actions": actions,
@@ -488,15 +831,19 @@ def parse_model(model, out_dir) -> TransformationDataModel:
                             'type': slot.source.__class__.__name__,
                             'verb': slot.source.eserviceRef.verb.lower(),
                             'url': data.eservices[slot.source.eserviceRef.name]['url'],
+                            'timeout': data.eservices[slot.source.eserviceRef.name]['timeout'],
+                            'retries': data.eservices[slot.source.eserviceRef.name]['retries'],
+                            'service': slot.source.eserviceRef.name,
+                            'cache': data.eservices[slot.source.eserviceRef.name]['cache'] is not None,
                             'query_params': query_params,
                             'path_params': path_params,
                             'header_params': header_params,
                             'body_params': body_params,
                             'response_filter': process_response_filter(slot.source.response_filter),
-                            'slots': list(set(path_slots + query_slots + header_slots + body_slots + previous_slot_list)),
+                            'slots': unique(path_slots + query_slots + header_slots + body_slots + previous_slot_list),
                             'previous_slot': previous_slot,
-                            'user_properties': list(set(path_user_properties+query_user_properties+header_user_properties+body_user_properties)),
-                            'system_properties': list(set(path_system_properties+query_system_properties+header_system_properties+body_system_properties))
+                            'user_properties': unique(path_user_properties+query_user_properties+header_user_properties+body_user_properties),
+                            'system_properties': unique(path_system_properties+query_system_properties+header_system_properties+body_system_properties)
                         }
                         validation_data.append({
                             'form': form,
@@ -661,14 +1008,11 @@ def parse_model(model, out_dir) -> TransformationDataModel:
                 if not path.isabs(data.ac_misc.policy_path):
                     data.ac_misc.policy_path = path.normpath(path.join(out_dir, data.ac_misc.policy_path))
                 
-                directory = path.dirname(data.ac_misc.policy_path)
-                if not path.exists(directory):
-                    os.makedirs(directory)
             else:
                 data.ac_misc.policy_path = 'user_role_mappings.txt'
 
-            with open(path.join(out_dir, data.ac_misc.policy_path), 'w') as f:
-                json.dump(data.ac_misc.role_users, f)
+            # The file is written (or created) along with the generated sources
+            data.files[data.ac_misc.policy_path] = json.dumps(data.ac_misc.role_users)
         else:
             if data.ac_misc.policy_path:
                 if not path.isabs(data.ac_misc.policy_path):
@@ -691,6 +1035,16 @@ def parse_model(model, out_dir) -> TransformationDataModel:
 
             data.ac_misc.authentication['method'] = model.access_control.authentication.method
 
+        # Identity caching only applies to third-party lookups
+        authentication = model.access_control.authentication
+        if authentication.method in ['slot', 'user_id']:
+            if authentication.cache_ttl or authentication.negative_cache_ttl:
+                print("WARNING: 'cache_ttl' and 'negative_cache_ttl' are not applicable to this authentication method")
+        else:
+            # An explicit 'cache_ttl: 0' turns the identity cache off
+            data.ac_misc.authentication['cache_ttl'] = authentication.cache_ttl if is_set(authentication, 'cache_ttl') else AUTH_DEFAULT_CACHE_TTL
+            data.ac_misc.authentication['negative_cache_ttl'] = authentication.negative_cache_ttl
+
 
     # Validate access control
     data = validate_access_control(data, model)
@@ -698,6 +1052,79 @@ def parse_model(model, out_dir) -> TransformationDataModel:
     return data
 
 
+def expand_intent_examples(name: str, phrases: List[List[List[str]]], limit: int = None) -> List[str]:
+    """
+        Expands the phrases of an intent into unique training examples.
+        Each phrase is a list of parts, each part holding its alternative words.
+        With a limit, the budget is shared among the phrases and each one is
+        sampled with sample_phrase_examples.
+    """
+    if limit is not None and limit < 1:
+        raise ValueError(f"The intent example limit must be a positive number, got {limit}")
+    totals = [math.prod(len(words) for words in text) for text in phrases]
+    if limit is None or sum(totals) <= limit:
+        examples = itertools.chain.from_iterable(sample_phrase_examples(text) for text in phrases)
+        return list(dict.fromkeys(examples))
+
+    # Give the smaller phrases their full share first and pass any unused
+    # budget on to the larger ones
+    budgets = [0] * len(phrases)
+    remaining = limit
+    order = sorted(range(len(phrases)), key=lambda i: totals[i])
+    for n, i in enumerate(order):
+        budgets[i] = min(totals[i], remaining // (len(phrases) - n))
+        remaining -= budgets[i]
+
+    examples = itertools.chain.from_iterable(
+        sample_phrase_examples(text, budget, seed=name) for text, budget in zip(phrases, budgets)
+    )
+    examples = list(dict.fromkeys(examples))
+    print(f"Intent {name}: {sum(totals)} example combinations capped to {len(examples)}")
+    return examples
+
+
+def sample_phrase_examples(text: List[List[str]], limit: int = None, seed: str = '') -> Iterator[str]:
+    """
+        Lazily yields the sentences of a phrase, one per combination of its parts' words.
+        With a limit, a deterministic stratified sample is yielded instead of the
+        full product. The first sentences step through all parts together, so every
+        word appears as long as the limit covers the largest part. The rest are
+        drawn from the remaining combinations with a seeded RNG.
+    """
+    sizes = [len(words) for words in text]
+    total = math.prod(sizes)
+    if limit is None or total <= limit:
+        for sentence in itertools.product(*text):
+            yield ' '.join(sentence)
+        return
+
+    def sentence(combination):
+        return ' '.join(words[i] for words, i in zip(text, combination))
+
+    def decode(index):
+        # Mixed-radix decoding of a position in the product
+        digits = []
+        for size in reversed(sizes):
+            index, digit = divmod(index, size)
+            digits.append(digit)
+        return tuple(reversed(digits))
+
+    seen = set()
+    for i in range(min(max(sizes), limit)):
+        combination = tuple(i % size for size in sizes)
+        seen.add(combination)
+        yield sentence(combination)
+
+    rng = random.Random(seed)
+    for index in rng.sample(range(total), min(total, limit + len(seen))):
+        if len(seen) >= limit:
+            return
+        combination = decode(index)
+        if combination not in seen:
+            seen.add(combination)
+            yield sentence(combination)
+
+
 def process_text(text):
     """ Takes a Text entity, processes the entities, slots, and user properties and converts them to string."""
     if isinstance(text, str):
@@ -833,7 +1260,7 @@ def process_eservice_params(params):
     if len(results) > 2:
         results = results[:-2]
     results = results + '}'
-    return results, list(set(slots)), list(set(user_properties)), list(set(system_properties))
+    return results, unique(slots), unique(user_properties), unique(system_properties)
 
 
 def process_eservice_params_as_dict(params):
@@ -905,7 +1332,7 @@ def process_eservice_params_as_dict(params):
             results[param.name] = ' '.join(new_slot)
         else:
             results[param.name] = param.value
-    return results, list(set(slots)), list(set(user_properties)), list(set(system_properties))
+    return results, unique(slots), unique(user_properties), unique(system_properties)
 
 def merge_header_mimes(header_params, mimes):
     if header_params != '{}':
@@ -1001,6 +1428,10 @@ def validate_access_control(data: TransformationDataModel, model) -> Transformat
 
     return data
 
+def unique(values) -> List:
+    ''' Drop duplicate values, keeping the first occurrence of each (unlike list(set())). '''
+    return list(dict.fromkeys(values))
+
 def unpack_nested_dict(dic: Dict[Any, Dict]) -> Set:
     ''' Unpack the values of a nested dictionary. Duplicate values are discarded. '''
 
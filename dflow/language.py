@@ -2,14 +2,15 @@ import json
 import os
 import pathlib
 from os.path import join
-from typing import Any, List
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List
 import uuid
 
 import textx.scoping.providers as scoping_providers
 from rich import pretty, print
 from textx import (
     TextXSemanticError,
-    get_children_of_type,
     language,
     metamodel_from_file,
     get_location,
@@ -19,6 +20,9 @@ from textx.scoping import GlobalModelRepository, ModelRepository
 import dflow.definitions as CONSTANTS
 
 from dflow.generator import validate_path_params, process_eservice_params_as_dict
+from dflow.utils import get_cached_metamodel, get_mm, is_set, load_model, reject_imports
+from dflow.cache import ModelCache
+from dflow.model_index import get_model_index
 
 pretty.install()
 
@@ -55,25 +59,38 @@ obj_processors = {
 }
 
 
-def get_metamodel(debug: bool = False, global_repo: bool = False):
+def _create_metamodel(debug: bool, global_repo: bool):
     metamodel = metamodel_from_file(
         join(CONSTANTS.THIS_DIR, 'grammar', 'dflow.tx'),
         classes=class_provider,
         auto_init_attributes=True,
         textx_tools_support=True,
-        # global_repository=GLOBAL_REPO,
-        global_repository=global_repo,
+        global_repository=GLOBAL_REPO if global_repo else False,
         debug=debug,
     )
 
-    # metamodel.register_scope_providers(get_scode_providers())
+    metamodel.register_scope_providers(get_scode_providers())
     metamodel.register_model_processor(model_proc)
     metamodel.register_obj_processors(obj_processors)
     return metamodel
 
 
+def get_metamodel(debug: bool = False, global_repo: bool = False):
+    """ Returns the process-wide dFlow metamodel for the given options. """
+    return get_cached_metamodel(
+        ('get_metamodel', debug, global_repo),
+        lambda: _create_metamodel(debug, global_repo)
+    )
+
+
+def warm_metamodels(debug: bool = False):
+    """ Builds the metamodels used for validation and code generation ahead of the first request. """
+    get_metamodel(debug=debug, global_repo=True)
+    get_mm(debug=debug)
+
+
 def get_scode_providers():
-    sp = {"*.*": scoping_providers.FQNImportURI(importAs=True)}
+    sp = {"*.*": scoping_providers.FQNImportURI(importAs=False)}
     if CONSTANTS.BUILTIN_MODELS:
         sp["brokers*"] = scoping_providers.FQNGlobalRepo(
             join(CONSTANTS.BUILTIN_MODELS, "broker", "*.dflow"))
@@ -100,9 +117,10 @@ def has_duplicates(input_list):
 def _validate_model(model):
     """ Runs semantic validation on the provided model and raises Errors. """
 
+    index = get_model_index(model)
     all_concept_names = []
     # Validate Intents
-    intents = get_children_of_type("Intent", model)
+    intents = index.of_type("Intent")
     if len(intents) < 1:
         raise TextXSemanticError("There must be at least 1 Intent provided!")
     intents_names = [i.name for i in intents]
@@ -117,7 +135,7 @@ def _validate_model(model):
             raise TextXSemanticError(f'Only {len(intent.phrases)} given in intent {intent}! At least 2 are needed!')
 
     # Validate Entities
-    entities = get_children_of_type("TrainableEntity", model)
+    entities = index.of_type("TrainableEntity")
     entities_names = [e.name for e in entities]
     check, _entity = has_duplicates(entities_names)
     if check:
@@ -161,7 +179,7 @@ def _validate_model(model):
             raise TextXSemanticError(f"No example given for Pretrained Entity `{pe}`.")
 
     # Validate Synonyms
-    synonyms = get_children_of_type("Synonym", model)
+    synonyms = index.of_type("Synonym")
     synonyms_names = [s.name for s in synonyms]
     check, _synonym = has_duplicates(synonyms_names)
     if check:
@@ -187,7 +205,7 @@ def _validate_model(model):
                     value_to_sets[item] = [idx]
 
     # Validate EServices
-    eservices = get_children_of_type("EServiceDefHTTP", model)
+    eservices = index.of_type("EServiceDefHTTP")
     eservices_names = [e.name for e in eservices]
     check, _eservice = has_duplicates(eservices_names)
     if check:
@@ -219,8 +237,21 @@ def _validate_model(model):
         service_info['url'] = f"{service_info['host']}{port}{service_info['path']}"
         eservices_info[service.name] = service_info
 
+        if service.timeout < 0 or (not service.timeout and is_set(service, 'timeout')):
+            raise TextXSemanticError(f"EService `{service.name}` timeout must be a positive number of seconds!")
+        if service.retries < 0:
+            raise TextXSemanticError(f"EService `{service.name}` retries must not be negative!")
+        if service.cache_ttl < 0 or service.cache_size < 0:
+            raise TextXSemanticError(f"EService `{service.name}` cache_ttl and cache_size must not be negative!")
+        if not service.cache_size and is_set(service, 'cache_size'):
+            raise TextXSemanticError(f"EService `{service.name}` cache_size must be a positive number of responses!")
+        if (service.cache_size or service.cache_backend) and not service.cache_ttl:
+            raise TextXSemanticError(f"EService `{service.name}` defines a cache without a cache_ttl!")
+        if service.cache_ttl and service.verb.lower() != 'get':
+            raise TextXSemanticError(f"EService `{service.name}` can not be cached, only GET services are!")
+
     # Validate Dialogues
-    dialogues = get_children_of_type("Dialogue", model)
+    dialogues = index.of_type("Dialogue")
     if not len(dialogues):
         raise TextXSemanticError("There must be at least 1 Dialogue!")
 
@@ -261,7 +292,7 @@ def _validate_model(model):
                             raise Exception(f'Service `{slot.source.eserviceRef.name}` path and path params do not match when called in `{response.name}` for slot `{slot.name}`.')
 
     # Validate Global Slots
-    gslots = get_children_of_type("GlobalSlot", model)
+    gslots = index.of_type("GlobalSlot")
     gslots_names = [gs.name for gs in gslots]
     check, _gslot = has_duplicates(gslots_names)
     if check:
@@ -271,7 +302,7 @@ def _validate_model(model):
     slot_names.extend(gslots_names)
 
     # Validate Events
-    events = get_children_of_type("Event", model)
+    events = index.of_type("Event")
     events_names = [e.name for e in events]
     check, _event = has_duplicates(events_names)
     if check:
@@ -279,7 +310,7 @@ def _validate_model(model):
     all_concept_names.extend(events_names)
 
     # Validate Access Control
-    access_control = get_children_of_type("AccessControlDef", model)
+    access_control = index.of_type("AccessControlDef")
     if access_control:
         roles = access_control[0].roles.words
         check, _role = has_duplicates(roles)
@@ -312,6 +343,9 @@ def _validate_model(model):
                 if action not in action_groups_names:
                     raise TextXSemanticError(f"Action: `{action}` in Policy `{policy.name}` is not a defined ActionGroup")
 
+        if access_control[0].authentication.cache_ttl < 0 or access_control[0].authentication.negative_cache_ttl < 0:
+            raise TextXSemanticError("Authentication cache_ttl and negative_cache_ttl must not be negative!")
+
         if access_control[0].authentication.method == 'slot':
             if not access_control[0].authentication.slot_name:
                 raise TextXSemanticError("You need to provide a 'slot_name' for this authentication method")
@@ -329,24 +363,160 @@ def _validate_model(model):
     return
 
 
-def build_model(model_path: str, debug: bool = False):
+def build_model(model_path: str, debug: bool = False, cache: ModelCache = None):
     # Parse model
-    mm = get_metamodel(debug=debug)
-    model = mm.model_from_file(model_path)
-    _validate_model(model)
+    if cache is None:
+        mm = get_metamodel(debug=debug, global_repo=True)
+        model = load_model(GLOBAL_REPO, lambda: mm.model_from_file(model_path), model_path)
+        _validate_model(model)
+        return model
+
+    with open(model_path, 'r', encoding='utf-8') as f:
+        return build_model_str(f.read(), debug=debug, cache=cache, file_name=model_path)
+
+
+def build_model_str(model_str, debug: bool = False, cache: ModelCache = None,
+                    file_name: str = None, self_contained: bool = False):
+    """
+        Parses and validates a model given as a string (or utf-8 bytes). A
+        self_contained model may not import other files.
+    """
+    if isinstance(model_str, bytes):
+        model_str = model_str.decode('utf-8')
+    if cache is None:
+        model = _parse_model_str(model_str, debug, file_name, self_contained)
+        _validate_model(model)
+        return model
+
+    key = _cache_key(cache, model_str, file_name, debug)
+    model = cache.get(key)
+    if model is None:
+        model = _parse_model_str(model_str, debug, file_name, self_contained)
+        if not cache.is_validated(key):
+            _validate_model(model)
+        if not _reads_environment(model):
+            cache.put(key, model)
     return model
 
 
+def _cache_key(cache: ModelCache, model_str: str, file_name: str = None,
+               debug: bool = False) -> str:
+    # Debug builds parse with a different metamodel, so they get their own entries
+    return cache.key(model_str, file_name, variant='language-debug' if debug else 'language')
+
+
+def _reads_environment(model) -> bool:
+    """
+        Whether the model is valid depending on files besides its text: its
+        imports, which may change on their own, or the user-role file of a
+        Path, which must exist. Such models are not cached.
+    """
+    if model.imports:
+        return True
+    return any(ac.path for ac in get_model_index(model).of_type("AccessControlDef"))
+
+
+def _parse_model_str(model_str: str, debug: bool, file_name: str = None,
+                     self_contained: bool = False):
+    # Imports are resolved through the global repository, which parses each library once
+    mm = get_metamodel(debug=debug, global_repo=True)
+    callback = reject_imports if self_contained else None
+    return load_model(GLOBAL_REPO,
+                      lambda: mm.model_from_str(model_str, file_name=file_name,
+                                                pre_ref_resolution_callback=callback),
+                      file_name)
+
+
+def validation_result(name: str, model_str=None, cache: ModelCache = None,
+                      self_contained: bool = False) -> Dict[str, Any]:
+    """
+        Validates a model and reports the outcome instead of raising. The model
+        is given as text, or read from the path in name when model_str is None.
+        A model that the cache knows to be valid is not parsed again.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        file_name = None
+        if model_str is None:
+            file_name = name
+            with open(name, 'r', encoding='utf-8') as f:
+                model_str = f.read()
+        elif isinstance(model_str, bytes):
+            model_str = model_str.decode('utf-8')
+        if cache is None or not cache.is_validated(_cache_key(cache, model_str, file_name)):
+            build_model_str(model_str, cache=cache, file_name=file_name,
+                            self_contained=self_contained)
+    except Exception as e:
+        error = str(e)
+    return {
+        'model': name,
+        'valid': error is None,
+        'error': error,
+        'duration': round(time.perf_counter() - start, 4)
+    }
+
+
+def validate_models(models, jobs: int = None, cache_dir: str = None) -> Iterator[Dict[str, Any]]:
+    """
+        Validates many models on a process pool; every worker builds the
+        metamodel once and reuses it for all the models it gets.
+
+        models holds model paths or (name, text) pairs. Yields the result of
+        each model as it finishes (see validation_result), followed by a
+        summary dict with the aggregate counts and timing.
+    """
+    start = time.perf_counter()
+    models = [(m, None) if isinstance(m, str) else tuple(m) for m in models]
+    jobs = jobs or os.cpu_count() or 1
+    valid = 0
+    pool = None
+    if jobs == 1 or len(models) <= 1:
+        results = (_validate_in_worker(name, text, cache_dir) for name, text in models)
+    else:
+        pool = ProcessPoolExecutor(max_workers=min(jobs, len(models)), initializer=warm_metamodels)
+        futures = [pool.submit(_validate_in_worker, name, text, cache_dir) for name, text in models]
+        results = (f.result() for f in as_completed(futures))
+    try:
+        for result in results:
+            valid += result['valid']
+            yield result
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    yield {
+        'summary': {
+            'total': len(models),
+            'valid': valid,
+            'invalid': len(models) - valid,
+            'jobs': jobs,
+            'duration': round(time.perf_counter() - start, 4)
+        }
+    }
+
+
+# Per-process model caches of validate_models workers, by cache directory
+_WORKER_CACHES = {}
+
+
+def _validate_in_worker(name, model_str, cache_dir):
+    cache = None
+    if cache_dir:
+        cache = _WORKER_CACHES.setdefault(cache_dir, ModelCache(cache_dir=cache_dir))
+    return validation_result(name, model_str, cache=cache)
+
+
 def report_model_info(model):
-    entities = get_children_of_type("TrainableEntity", model)
-    synonyms = get_children_of_type("Synonym", model)
-    gslots = get_children_of_type("GlobalSlot", model)
-    intents = get_children_of_type("Intent", model)
-    events = get_children_of_type("Event", model)
-    eservices = get_children_of_type("EServiceDefHTTP", model)
-    dialogues = get_children_of_type("Dialogue", model)
-    access_control = get_children_of_type("AccessControlDef", model)
-    connectors = get_children_of_type("Slack", model) + get_children_of_type("Telegram", model)
+    index = get_model_index(model)
+    entities = index.of_type("TrainableEntity")
+    synonyms = index.of_type("Synonym")
+    gslots = index.of_type("GlobalSlot")
+    intents = index.of_type("Intent")
+    events = index.of_type("Event")
+    eservices = index.of_type("EServiceDefHTTP")
+    dialogues = index.of_type("Dialogue")
+    access_control = index.of_type("AccessControlDef")
+    connectors = index.of_type("Slack") + index.of_type("Telegram")
     print(f"Trainable Entities: {[e.name for e in entities]}")
     print(f"Synonyms: {[s.name for s in synonyms]}")
     print(f"Global Slots: {[gs.name for gs in gslots]}")
@@ -365,47 +535,154 @@ def dflow_language():
     return mm
 
 
-def merge_models(models: List[Any], output: bool = False):
-    sections = [
-        'entities',
-        'synonyms',
-        'gslots',
-        'triggers',
-        'dialogues',
-        'eservices'
-    ]
-    merged_strings = {k: '' for k in sections}
-
-    for model in models:
-        # Use list os sections to find keywords in file
-        indexes = []
-        for section in sections:
-            i = model.find(section)
-            indexes.append(i)
-        # Sort sections based on appearance in file
-        indexes, sections = zip(*sorted(zip(indexes, sections)))
-
-        # Extract each section in reverse order
-        for i in reversed(range(len(indexes))):
-            ind = indexes[i]
-            # ind == -1 if keyword doesn't exist in model
-            if ind >= 0:
-                part = model[ind:]
-                model = model[:ind]
-                end_i = part.rfind('end')
-                merged_strings[sections[i]] += part[len(sections[i]):end_i]
-
-    # Add section name the begining and 'end' in the end of each section
-    for section in merged_strings:
-        merged_strings[section] = section + merged_strings[section] + '\nend'
-    merged_str = '\n\n'.join([
-        merged_strings['gslots'],
-        merged_strings['entities'],
-        merged_strings['synonyms'],
-        merged_strings['triggers'],
-        merged_strings['eservices'],
-        merged_strings['dialogues'],
-    ])
+# Sections of a dFlow model in the order merge_models writes them:
+# (keyword, model attribute, separator of the elements or None for single-valued sections)
+MODEL_SECTIONS = [
+    ('entities', 'entities', '\n'),
+    ('synonyms', 'synonyms', '\n'),
+    ('gslots', 'gslots', ',\n'),
+    ('triggers', 'triggers', '\n'),
+    ('dialogues', 'dialogues', '\n'),
+    ('eservices', 'eservices', '\n'),
+    ('access_controls', 'access_control', None),
+    ('connectors', 'connectors', '\n'),
+    ('nluconfig', 'nlu_config', None),
+]
+
+
+class MergeConflictError(Exception):
+    """ Raised when the merged models define the same ID differently. """
+
+    def __init__(self, collisions: List[str]):
+        super().__init__("Conflicting definitions:\n" + "\n".join(collisions))
+        self.collisions = collisions
+
+
+class _UnresolvedModel(Exception):
+    def __init__(self, model):
+        self.model = model
+
+
+def _stop_before_resolution(model):
+    raise _UnresolvedModel(model)
+
+
+def parse_fragment(model_str: str, file_name: str = None):
+    """
+        Parses a model without resolving its references, so that fragments
+        which refer to objects defined in other fragments can be read on
+        their own.
+    """
+    mm = get_metamodel()
+    try:
+        return mm.model_from_str(model_str, file_name=file_name,
+                                 pre_ref_resolution_callback=_stop_before_resolution)
+    except _UnresolvedModel as e:
+        return e.model
+
+
+def _element_text(model_str: str, obj) -> str:
+    # Source text of an element, along with the indentation of its first line
+    line_start = model_str.rfind('\n', 0, obj._tx_position) + 1
+    indent = model_str[line_start:obj._tx_position]
+    if indent.strip():
+        indent = ''
+    return indent + model_str[obj._tx_position:obj._tx_position_end].rstrip()
+
+
+def _nested_ids(obj) -> List[str]:
+    """ IDs defined inside a top-level element, i.e. the responses of a dialogue. """
+    return [response.name for response in getattr(obj, 'responses', None) or []]
+
+
+def merge_models(models: List[Any], output: bool = False, names: List[str] = None):
+    """
+        Merges model fragments into a single model, section by section.
+
+        Each fragment is parsed once (without resolving references) and its
+        elements are copied by their source positions. An ID defined again
+        with the same text is kept once; an ID defined differently, including
+        the IDs of dialogue responses, or two different Metadata,
+        access_controls or nluconfig sections, raise a MergeConflictError
+        listing every collision.
+
+        The imports of the fragments are kept once each, at the top of the
+        merged model, with their paths as written. Imports of files that are
+        merged themselves (by the fragment names) are dropped.
+    """
+    names = names or [f"model {i + 1}" for i in range(len(models))]
+    singles = {}
+    imports = []
+    merged_paths = {os.path.abspath(name) for name in names}
+    elements = {attr: [] for _, attr, _ in MODEL_SECTIONS}
+    # ID -> (section, normalized text, fragment name) of its first definition
+    defined = {}
+    collisions = []
+
+    def normalize(text):
+        return ' '.join(text.split())
+
+    def add_single(section, text, name):
+        first = singles.get(section)
+        if first is None:
+            singles[section] = (normalize(text), name, text)
+        elif first[0] != normalize(text):
+            collisions.append(f"'{section}' is defined in {first[1]} and {name}")
+
+    for model_str, name in zip(models, names):
+        if isinstance(model_str, bytes):
+            model_str = model_str.decode('utf-8')
+        model = parse_fragment(model_str)
+
+        for model_import in model.imports:
+            target = os.path.join(os.path.dirname(name), model_import.importURI)
+            text = _element_text(model_str, model_import).strip()
+            if os.path.abspath(target) not in merged_paths and text not in imports:
+                imports.append(text)
+        if model.metadata:
+            add_single('Metadata', _element_text(model_str, model.metadata), name)
+        for section, attr, sep in MODEL_SECTIONS:
+            value = getattr(model, attr, None)
+            if not value:
+                continue
+            if sep is None:
+                add_single(section, _element_text(model_str, value), name)
+                continue
+            for obj in value:
+                text = _element_text(model_str, obj)
+                obj_id = getattr(obj, 'name', None) or normalize(text)
+                first = defined.get(obj_id)
+                if first is None:
+                    defined[obj_id] = (section, normalize(text), name)
+                    elements[attr].append(text)
+                    # Responses share the ID namespace of the top-level elements
+                    for nested_id in _nested_ids(obj):
+                        first = defined.get(nested_id)
+                        location = f"{section}, in {obj_id}"
+                        if first is None:
+                            defined[nested_id] = (location, None, name)
+                        else:
+                            collisions.append(
+                                f"'{nested_id}' is defined in {first[2]} ({first[0]}) and {name} ({location})")
+                elif first[:2] != (section, normalize(text)):
+                    collisions.append(
+                        f"'{obj_id}' is defined in {first[2]} ({first[0]}) and {name} ({section})")
+
+    if collisions:
+        raise MergeConflictError(collisions)
+
+    parts = []
+    if imports:
+        parts.append('\n'.join(imports))
+    if 'Metadata' in singles:
+        parts.append(singles['Metadata'][2])
+    for section, attr, sep in MODEL_SECTIONS:
+        if sep is None:
+            if section in singles:
+                parts.append(f"{section}\n{singles[section][2]}\nend")
+        elif elements[attr]:
+            parts.append(f"{section}\n" + sep.join(elements[attr]) + "\nend")
+    merged_str = '\n\n'.join(parts) + '\n'
 
     if output:
         gen_path = os.path.join(CONSTANTS.TMP_DIR,
@@ -0,0 +1,189 @@
+"""
+    Client of the LLM chat service.
+
+    One LLMClient keeps a pooled keep-alive session to the service, bounds
+    the number of requests in flight and retries throttled (429) and failed
+    (5xx, connection errors, timeouts) requests with jittered exponential
+    backoff. Every call is recorded, so the latency of the LLM-bound paths
+    (e.g. openapi_to_dflow) can be inspected through stats().
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LLM_URL = os.getenv("LLM_URL", "https://services.issel.ee.auth.gr/llms/chat")
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+class LLMError(Exception):
+    """ Raised when the LLM service can not answer a request. """
+
+
+class LLMClient():
+    """
+        Pooled, rate-limited client of the LLM chat service.
+
+        timeout is (connect, read) in seconds. A request is attempted at most
+        retries + 1 times and at most max_concurrency requests are in flight
+        at once, the rest wait for a free slot. Waits between attempts,
+        including the Retry-After of the service, last at most max_backoff.
+    """
+
+    def __init__(self,
+                 url: str = LLM_URL,
+                 api_key: str = None,
+                 timeout=(5, 60),
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 max_backoff: float = 30,
+                 max_concurrency: int = 8,
+                 history: int = 1000):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key is not None:
+            self.session.headers['access_token'] = api_key
+        self.calls = deque(maxlen=history)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'LLMClient':
+        """ Builds the client from the LLM_* environment variables. """
+        return cls(url=os.getenv("LLM_URL", LLM_URL),
+                   api_key=os.getenv("ISSEL_API_KEY", "123"),
+                   timeout=(float(os.getenv("LLM_CONNECT_TIMEOUT", 5)),
+                            float(os.getenv("LLM_TIMEOUT", 60))),
+                   retries=int(os.getenv("LLM_RETRIES", 3)),
+                   backoff=float(os.getenv("LLM_BACKOFF", 0.5)),
+                   max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)))
+
+    def chat(self, system_prompt: str = '', messages: List[dict] = [],
+             temperature: float = 0) -> str:
+        """ Sends a chat request and returns the text of the answer. """
+        payload = {"system_prompt": system_prompt, "messages": messages}
+        start = time.perf_counter()
+        attempts = 0
+        status = None
+        body = None
+        error = None
+        while True:
+            attempts += 1
+            retry_after = None
+            try:
+                # Only the request holds a slot, waiting to retry does not
+                with self._slots:
+                    response = self.session.post(self.url, json=payload,
+                                                 params={"temperature": temperature},
+                                                 timeout=self.timeout)
+                status = response.status_code
+                if status not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    body = response.json()
+                    break
+                error = f"HTTP {status}"
+                retry_after = _retry_after(response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            except (requests.RequestException, ValueError) as e:
+                # Client errors and malformed answers do not improve on retry
+                error = str(e)
+                break
+            if attempts > self.retries:
+                break
+            if retry_after is not None:
+                time.sleep(min(retry_after, self.max_backoff))
+            else:
+                time.sleep(self._backoff(attempts))
+
+        text = body.get('text') if isinstance(body, dict) else None
+        self._record({
+            'latency': round(time.perf_counter() - start, 4),
+            'attempts': attempts,
+            'status': status,
+            'ok': text is not None,
+            'prompt_chars': len(system_prompt) + sum(len(m.get('prompt', '')) for m in messages),
+            'response_chars': len(text) if text is not None else 0,
+            'tokens': _usage_tokens(body),
+        })
+        if text is None:
+            raise LLMError(error or "LLM service returned no text")
+        return text
+
+    def stats(self) -> Dict[str, Any]:
+        """ Returns aggregate metrics over the recorded calls. """
+        with self._lock:
+            calls = list(self.calls)
+        latencies = sorted(c['latency'] for c in calls)
+        tokens = [c['tokens'] for c in calls if c['tokens'] is not None]
+        return {
+            'calls': len(calls),
+            'failed': sum(1 for c in calls if not c['ok']),
+            'retries': sum(c['attempts'] - 1 for c in calls),
+            'latency_avg': round(sum(latencies) / len(latencies), 4) if latencies else None,
+            'latency_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+            'tokens': sum(tokens) if tokens else None,
+        }
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, so that concurrent callers do not retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def _record(self, call: Dict[str, Any]) -> None:
+        with self._lock:
+            self.calls.append(call)
+
+
+def _retry_after(response) -> float:
+    try:
+        return max(0.0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+
+def _usage_tokens(body) -> int:
+    """ Total tokens of a call, when the service reports its usage. """
+    if not isinstance(body, dict) or not isinstance(body.get('usage'), dict):
+        return None
+    usage = body['usage']
+    if 'total_tokens' in usage:
+        return usage['total_tokens']
+    return usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """ Returns the process-wide LLM client, built from the environment on first use. """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = LLMClient.from_env()
+        return _CLIENT
+
+
+def set_llm_client(client: LLMClient) -> None:
+    """ Replaces the process-wide LLM client, e.g. with one pointing at a local mock. """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        _CLIENT = client
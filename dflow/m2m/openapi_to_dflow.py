@@ -1,6 +1,7 @@
 from collections import Counter
+import ast
 import os
-import jinja2
+import threading
 import requests
 import yaml
 import json
@@ -10,7 +11,12 @@ from dotenv import dotenv_values
 from pydantic import BaseModel
 from typing import Tuple, Optional, Any, Union, Optional
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from dflow.utils import llm_invoke, create_user_prompt_message, create_assistant_prompt_message
+from dflow.utils import get_jinja_env, M2M_JINJA_OPTIONS
+from dflow.llm import get_llm_client
+from dflow.cache import ResponseCache
+from dflow.definitions import CACHE_DIR
 
 class RestVerb(str, Enum):
     get = 'GET'
@@ -92,10 +98,68 @@ class Dialogue(BaseModel):
 
 TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(os.path.dirname(__file__))), 'templates')
 
-jinja_env = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(TEMPLATE_DIR))
+jinja_env = get_jinja_env(**M2M_JINJA_OPTIONS)
 template = jinja_env.get_template('model.dflow.jinja')
 
+# Number of LLM requests in flight while transforming a specification
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+
+# LLM responses are kept on disk, so re-running a specification is almost free.
+# Set LLM_CACHE=0 to always ask the LLM service.
+_LLM_CACHE = None
+_LLM_CACHE_CREATED = False
+_LLM_CACHE_LOCK = threading.Lock()
+
+
+def get_llm_cache() -> Optional[ResponseCache]:
+    """ Returns the LLM response cache, created on first use, or None if it is disabled. """
+    global _LLM_CACHE, _LLM_CACHE_CREATED
+    with _LLM_CACHE_LOCK:
+        if not _LLM_CACHE_CREATED:
+            _LLM_CACHE = _create_llm_cache()
+            _LLM_CACHE_CREATED = True
+        return _LLM_CACHE
+
+
+def _create_llm_cache():
+    if os.getenv("LLM_CACHE", "1") == "0":
+        return None
+    # Without a writable cache directory, every request goes to the LLM service
+    try:
+        cache = ResponseCache(os.getenv("LLM_CACHE_DIR", os.path.join(CACHE_DIR, 'llm')))
+    except OSError:
+        return None
+    if not os.access(cache.cache_dir, os.W_OK):
+        return None
+    return cache
+
+
+def cached_llm_invoke(system_prompt: str = '', messages: list = [], temperature: float = 0,
+                      parse=None):
+    """
+        Same as llm_invoke, answering repeated requests from the LLM cache.
+        parse, if given, converts the answer and raises ValueError when the
+        answer is malformed. The parsed answer is returned, and only answers
+        that parse are cached.
+    """
+    parse = parse or (lambda response: response)
+    cache = get_llm_cache()
+    if cache is None:
+        return parse(llm_invoke(system_prompt, messages=messages, temperature=temperature))
+    key = cache.key(url=get_llm_client().url, system_prompt=system_prompt,
+                    messages=messages, temperature=temperature)
+    response = cache.get(key)
+    if response is not None:
+        try:
+            return parse(response)
+        except ValueError:
+            # A malformed answer is not served again, but replaced
+            pass
+    response = llm_invoke(system_prompt, messages=messages, temperature=temperature)
+    parsed = parse(response)
+    cache.put(key, response)
+    return parsed
+
 
 def extract_properties_from_schema(schema, model, parent_path="") -> dict:
     """Extract properties from a given schema and return them as a dictionary."""
@@ -373,15 +437,17 @@ def generate_intent_examples(description: Optional[str], summary: Optional[str])
     if summary:
         _prompt += f"Description: {summary} "
     msg = create_user_prompt_message(_prompt)
-    response = llm_invoke(system_prompt, messages=[msg])
-    response = eval(response)
-    return response
-
-def create_trigger(name, description, summary) -> Trigger:
-    return Trigger(
-        name=name,
-        phrases=generate_intent_examples(description, summary)
-    )
+    return cached_llm_invoke(system_prompt, messages=[msg], parse=parse_intent_examples)
+
+def parse_intent_examples(response: str) -> list[str]:
+    """ Reads the Python list of intent examples answered by the LLM. """
+    try:
+        examples = ast.literal_eval(response.strip())
+    except (SyntaxError, ValueError):
+        raise ValueError(f"LLM answer is not a Python list: {response!r}")
+    if not isinstance(examples, list) or not all(isinstance(e, str) for e in examples):
+        raise ValueError(f"LLM answer is not a list of strings: {response!r}")
+    return examples
 
 def create_response(verb: str, request_params: list, response_params: list, summary: str):
 
@@ -408,7 +474,7 @@ Summary: {summary}
 Response:
 """
     msg = create_user_prompt_message(_prompt)
-    response = llm_invoke(system_prompt, messages=[msg], temperature=0.1)
+    response = cached_llm_invoke(system_prompt, messages=[msg], temperature=0.1)
     response = response.replace('\n', ' ')
     response = response.replace('{{', "'")
     response = response.replace('}}', "'")
@@ -542,50 +608,61 @@ def create_dialogue(
         responses=responses
     )
 
-def openapi_to_dflow(model: dict):
-    "Transforms OpenAPI model to dFlow"
+def openapi_to_dflow(model: dict, workers: int = None):
+    """
+        Transforms OpenAPI model to dFlow.
+
+        The LLM requests of the operations run on a pool of `workers` threads
+        (LLM_CONCURRENCY by default). Results are collected in operation
+        order, so the output matches a sequential run.
+    """
     services = transform_to_ext_eservices(model)
-    i = 0
-    dflow_eservices = []
-    dflow_triggers = []
-    dflow_dialogues = []
-    for service in services:
-        service_name = create_name(service.name, ending = f"svc_{i}")
-        intent_name = create_name(service.name, ending = f"{i}")
-        dialogue_name = create_name(service.name, ending = f"dlg_{i}")
-        
-        eservice_definition = create_service(
-            model=model,
-            name=service_name, 
-            service=service
-        )
-
-        triggers = create_trigger(
-            name=intent_name, 
-            description=service.description,
-            summary=service.summary
-        )
-        if triggers == []:
-            continue
-        dialogue = create_dialogue(
-            model=model,
-            dialogue_name=dialogue_name, 
-            intent_name=intent_name, 
-            service_name=service_name,
-            verb=service.verb,
-            response=service.response, 
-            path=service.path, 
-            summary=service.summary,
-            headerParams=service.headerParams,
-            queryParams=service.queryParams,
-            pathParams=service.pathParams,
-            bodyParams=service.bodyParams
-        )
-
-        dflow_eservices.append(eservice_definition)
-        dflow_triggers.append(triggers)
-        dflow_dialogues.append(dialogue)
-        i += 1
+    with ThreadPoolExecutor(max_workers=workers or LLM_CONCURRENCY,
+                            thread_name_prefix='dflow-llm') as pool:
+        # Intent examples do not depend on the naming, so they are requested first
+        examples = list(pool.map(
+            lambda service: generate_intent_examples(service.description, service.summary),
+            services
+        ))
+
+        # Names are numbered over the operations that got intent examples
+        i = 0
+        dflow_eservices = []
+        dflow_triggers = []
+        dialogue_jobs = []
+        for service, phrases in zip(services, examples):
+            if not phrases:
+                continue
+            service_name = create_name(service.name, ending = f"svc_{i}")
+            intent_name = create_name(service.name, ending = f"{i}")
+            dialogue_name = create_name(service.name, ending = f"dlg_{i}")
+
+            eservice_definition = create_service(
+                model=model,
+                name=service_name, 
+                service=service
+            )
+            triggers = Trigger(name=intent_name, phrases=phrases)
+            dialogue_jobs.append(pool.submit(
+                create_dialogue,
+                model=model,
+                dialogue_name=dialogue_name, 
+                intent_name=intent_name, 
+                service_name=service_name,
+                verb=service.verb,
+                response=service.response, 
+                path=service.path, 
+                summary=service.summary,
+                headerParams=service.headerParams,
+                queryParams=service.queryParams,
+                pathParams=service.pathParams,
+                bodyParams=service.bodyParams
+            ))
+
+            dflow_eservices.append(eservice_definition)
+            dflow_triggers.append(triggers)
+            i += 1
+        dflow_dialogues = [job.result() for job in dialogue_jobs]
 
     output = template.render(eservices=dflow_eservices, triggers=dflow_triggers, dialogues=dflow_dialogues)
     return output
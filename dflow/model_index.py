@@ -0,0 +1,56 @@
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from textx import get_children
+
+
+class ModelIndex():
+    """
+        Single-pass index of a dFlow model.
+
+        Walks the textX containment tree once and buckets every object by its
+        type name (same semantics as textx.get_children_of_type).
+
+        Models imported by the model (libraries) are indexed too, after the
+        model itself.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.models = [model] + imported_models(model)
+        self.objects: Dict[str, List[Any]] = defaultdict(list)
+
+        for obj in (o for m in self.models for o in get_children(lambda _: True, m)):
+            self.objects[obj.__class__.__name__].append(obj)
+
+    def of_type(self, typename: str) -> List[Any]:
+        """ Returns all objects of the given type, in model order. """
+        return self.objects.get(typename, [])
+
+    def section(self, name: str) -> List[Any]:
+        """ Returns the elements of a model section (e.g. 'triggers') across the model and its imports. """
+        return [obj for m in self.models for obj in (getattr(m, name, None) or [])]
+
+
+def imported_models(model) -> List[Any]:
+    """ Returns the models imported by the model, directly or through other imports. """
+    found, pending = [], [model]
+    seen = {id(model)}
+    while pending:
+        repo = getattr(pending.pop(0), '_tx_model_repository', None)
+        local_models = getattr(repo, 'local_models', None)
+        for imported in (local_models or []):
+            if id(imported) not in seen:
+                seen.add(id(imported))
+                found.append(imported)
+                pending.append(imported)
+    return found
+
+
+def get_model_index(model) -> ModelIndex:
+    """ Returns the index of the model, building it on first use. """
+    index = getattr(model, '_dflow_index', None)
+    if index is None:
+        index = ModelIndex(model)
+        model._dflow_index = index
+    return index
@@ -1,17 +1,174 @@
 import os
-import requests
+import re
+import hashlib
+import threading
+import jinja2
 from os.path import dirname, join
-from textx import metamodel_from_file
+from textx import metamodel_from_file, get_model
 import textx.scoping.providers as scoping_providers
 
+from dflow.definitions import CACHE_DIR, TEMPLATES_PATH
+from dflow.model_index import imported_models
+from dflow.llm import get_llm_client
+
 
 this_dir = dirname(__file__)
+grammar_dir = join(this_dir, 'grammar')
 
 ISSEL_API_KEY = os.getenv("ISSEL_API_KEY", "123")
 
-def get_mm(debug=False, global_scope=True):
+class ModelImportError(ValueError):
+    """ Raised when a model that must be self-contained imports other files. """
+
+
+# Process-wide metamodel registry, keyed by the options each variant is built with
+_METAMODELS = {}
+_METAMODELS_LOCK = threading.Lock()
+
+# Digest of the grammar files, computed on first use
+_GRAMMAR_CHECKSUM = None
+
+# Digest of the code generation templates, computed on first use
+_TEMPLATES_CHECKSUM = None
+
+# Modules whose code decides whether a model is valid
+VALIDATOR_SOURCES = ('language.py', 'generator.py', 'model_index.py', 'utils.py')
+
+# Digest of the validator modules, computed on first use
+_VALIDATOR_CHECKSUM = None
+
+# Serializes builds on metamodels that own a global model repository
+_GLOBAL_REPO_LOCK = threading.Lock()
+
+# Modification times of the model files held by global model repositories,
+# keyed by (repository id, file name)
+_MODEL_MTIMES = {}
+
+# Process-wide Jinja environments over dflow/templates, keyed by their options
+_JINJA_ENVS = {}
+_JINJA_ENVS_LOCK = threading.Lock()
+
+# Options of the environments dFlow renders with (generator and openapi_to_dflow)
+GENERATOR_JINJA_OPTIONS = {'trim_blocks': True, 'lstrip_blocks': True}
+M2M_JINJA_OPTIONS = {}
+
+
+def grammar_checksum() -> str:
+    """ Returns a SHA-256 digest over the grammar files the metamodels are built from. """
+    global _GRAMMAR_CHECKSUM
+    if _GRAMMAR_CHECKSUM is None:
+        digest = hashlib.sha256()
+        for fname in sorted(os.listdir(grammar_dir)):
+            if not fname.endswith('.tx'):
+                continue
+            digest.update(fname.encode('utf-8'))
+            with open(join(grammar_dir, fname), 'rb') as f:
+                digest.update(f.read())
+        _GRAMMAR_CHECKSUM = digest.hexdigest()
+    return _GRAMMAR_CHECKSUM
+
+
+def templates_checksum() -> str:
+    """ Returns a SHA-256 digest over the files under dflow/templates. """
+    global _TEMPLATES_CHECKSUM
+    if _TEMPLATES_CHECKSUM is None:
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(TEMPLATES_PATH):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for fname in sorted(files):
+                fpath = join(root, fname)
+                digest.update(os.path.relpath(fpath, TEMPLATES_PATH).encode('utf-8'))
+                with open(fpath, 'rb') as f:
+                    digest.update(f.read())
+        _TEMPLATES_CHECKSUM = digest.hexdigest()
+    return _TEMPLATES_CHECKSUM
+
+
+def validator_checksum() -> str:
+    """ Returns a SHA-256 digest over the modules that validate models (VALIDATOR_SOURCES). """
+    global _VALIDATOR_CHECKSUM
+    if _VALIDATOR_CHECKSUM is None:
+        digest = hashlib.sha256()
+        for fname in VALIDATOR_SOURCES:
+            digest.update(fname.encode('utf-8'))
+            with open(join(this_dir, fname), 'rb') as f:
+                digest.update(f.read())
+        _VALIDATOR_CHECKSUM = digest.hexdigest()
+    return _VALIDATOR_CHECKSUM
+
+
+def get_jinja_env(bytecode_cache: bool = True, **options) -> jinja2.Environment:
+    """
+        Returns the shared Jinja environment over dflow/templates for the given
+        environment options.
+
+        Compiled templates are persisted under CACHE_DIR/jinja, so a fresh
+        process loads them instead of compiling them again. Jinja stores the
+        checksum of the template source with each entry and recompiles the
+        templates that changed.
+    """
+    key = (bytecode_cache, tuple(sorted(options.items())))
+    with _JINJA_ENVS_LOCK:
+        env = _JINJA_ENVS.get(key)
+        if env is None:
+            env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(TEMPLATES_PATH),
+                bytecode_cache=_create_bytecode_cache(options) if bytecode_cache else None,
+                **options)
+            _JINJA_ENVS[key] = env
+    return env
+
+
+def _create_bytecode_cache(options):
+    # The same source compiles differently under different options,
+    # so each option set gets its own directory.
+    digest = hashlib.sha256(
+        f"{jinja2.__version__}:{sorted(options.items())}".encode('utf-8')).hexdigest()[:16]
+    directory = join(CACHE_DIR, 'jinja', digest)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    if not os.access(directory, os.W_OK):
+        return None
+    return jinja2.FileSystemBytecodeCache(directory)
+
+
+def precompile_templates() -> int:
+    """
+        Compiles all templates under dflow/templates into the bytecode cache,
+        e.g. at image build time. Returns the number of compiled templates.
+    """
+    count = 0
+    for options in (GENERATOR_JINJA_OPTIONS, M2M_JINJA_OPTIONS):
+        env = get_jinja_env(**options)
+        for name in env.list_templates(extensions=['jinja']):
+            env.get_template(name)
+            count += 1
+    return count
+
+
+def get_cached_metamodel(key, factory):
+    """ Returns the metamodel registered under key, building it with factory on first use. """
+    with _METAMODELS_LOCK:
+        mm = _METAMODELS.get(key)
+        if mm is None:
+            mm = factory()
+            _METAMODELS[key] = mm
+        return mm
+
+
+def invalidate_metamodels():
+    """ Drops every cached metamodel, so that the next request rebuilds it from the grammar. """
+    global _GRAMMAR_CHECKSUM
+    with _METAMODELS_LOCK:
+        _METAMODELS.clear()
+        _GRAMMAR_CHECKSUM = None
+
+
+def _create_mm(debug, global_scope):
     mm = metamodel_from_file(
-        join(this_dir, 'grammar', 'dflow.tx'),
+        join(grammar_dir, 'dflow.tx'),
         global_repository=global_scope,
         debug=debug
     )
@@ -19,7 +176,7 @@ def get_mm(debug=False, global_scope=True):
     mm.register_scope_providers(
         {
             "*.*": scoping_providers.FQNImportURI(
-                importAs=True,
+                importAs=False,
             )
         }
     )
@@ -27,35 +184,147 @@ def get_mm(debug=False, global_scope=True):
     return mm
 
 
-def build_model(model_fpath):
+def get_mm(debug=False, global_scope=True):
+    return get_cached_metamodel(
+        ('get_mm', debug, global_scope),
+        lambda: _create_mm(debug, global_scope)
+    )
+
+
+def build_model(model_fpath, cache=None):
+    """
+        Parses the model file and returns it along with the models it imports.
+        An optional dflow.cache.ModelCache skips re-parsing identical models.
+    """
+    if cache is not None:
+        with open(model_fpath, 'r', encoding='utf-8') as f:
+            key = cache.key(f.read(), model_fpath, variant='utils')
+        result = cache.get(key)
+        if result is None:
+            result = build_model(model_fpath)
+            # Imported libraries may change on their own, so only self-contained models are cached
+            if not result[1]:
+                cache.put(key, result, validated=False)
+        return result
+
     mm = get_mm(global_scope=True)
-    model = mm.model_from_file(model_fpath)
-    # print(model._tx_loaded_models)
-    reg_models = mm._tx_model_repository.all_models.filename_to_model
-    models = [val for _, val in reg_models.items() if val != model]
-    return (model, models)
+    model = load_model(mm._tx_model_repository,
+                       lambda: mm.model_from_file(model_fpath), model_fpath)
+    return (model, imported_models(model))
+
+
+def build_model_str(model_str, cache=None, self_contained=False):
+    """
+        Same as build_model, but for a model given as a string (or utf-8 bytes).
+        A self_contained model may not import other files (see reject_imports).
+    """
+    if isinstance(model_str, bytes):
+        model_str = model_str.decode('utf-8')
+    if cache is not None:
+        key = cache.key(model_str, variant='utils')
+        result = cache.get(key)
+        if result is None:
+            result = build_model_str(model_str, self_contained=self_contained)
+            if not result[1]:
+                cache.put(key, result, validated=False)
+        return result
+
+    mm = get_mm(global_scope=True)
+    callback = reject_imports if self_contained else None
+    model = load_model(mm._tx_model_repository,
+                       lambda: mm.model_from_str(model_str, pre_ref_resolution_callback=callback))
+    return (model, imported_models(model))
+
+
+def reject_imports(model) -> None:
+    """
+        pre_ref_resolution_callback that refuses a model importing other
+        files. textX calls it once the model is parsed and before the imports
+        are loaded, so nothing is read from the file system.
+    """
+    if getattr(model, 'imports', None):
+        uris = ', '.join(f'"{i.importURI}"' for i in model.imports)
+        raise ModelImportError(
+            f"Model imports are not supported here ({uris}). Merge the model files first.")
+
+
+def load_model(repo, load, file_name=None):
+    """
+        Loads a model with load() through a global model repository, which
+        keeps the imported libraries parsed between builds. The loaded model
+        itself (file_name) is released afterwards, unless it was already held
+        as a library, so that the repository only grows with the libraries.
+    """
+    with _GLOBAL_REPO_LOCK:
+        refresh_repository(repo)
+        held = set(repo.all_models.filename_to_model)
+        try:
+            return load()
+        finally:
+            if file_name is not None:
+                fname = os.path.abspath(file_name)
+                model = repo.all_models.filename_to_model.get(fname)
+                # textX registers the model before resolving its references,
+                # so it is there even when the build failed
+                if model is not None and fname not in held:
+                    repo.remove_model(model)
+            track_repository(repo)
+
+
+def refresh_repository(repo) -> None:
+    """
+        Drops the models of a global model repository whose files changed
+        since they were loaded, along with the models importing them, so that
+        the next build reads them again. Unchanged libraries stay parsed and
+        are shared by every build.
+    """
+    models = repo.all_models.filename_to_model
+    stale = set()
+    for fname in models:
+        try:
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            mtime = None
+        if _MODEL_MTIMES.get((id(repo), fname)) != mtime:
+            stale.add(fname)
+    # A model that imports a stale one references its old objects
+    importers = {fname: {m._tx_filename for m in imported_models(model)}
+                 for fname, model in models.items()}
+    stale.update(fname for fname, imports in importers.items() if imports & stale)
+    if stale:
+        repo.remove_models([models[fname] for fname in stale])
+        for fname in stale:
+            _MODEL_MTIMES.pop((id(repo), fname), None)
+
+
+def track_repository(repo) -> None:
+    """ Records the modification times of newly loaded repository models. """
+    for fname in repo.all_models.filename_to_model:
+        if (id(repo), fname) not in _MODEL_MTIMES:
+            try:
+                _MODEL_MTIMES[(id(repo), fname)] = os.path.getmtime(fname)
+            except OSError:
+                pass
+
+
+def is_set(obj, attr: str) -> bool:
+    """
+        Whether the model spells out an optional attribute of an element.
+        textX initialises unset numbers to 0, so an explicit `attr: 0` is only
+        told apart from a missing one by the source text of the element.
+    """
+    text = get_model(obj)._tx_parser.input[obj._tx_position:obj._tx_position_end]
+    return re.search(rf'(?<![\w.]){re.escape(attr)}\s*:', text) is not None
 
 
 def get_grammar():
-    with open(join(this_dir, 'grammar', 'dflow.tx')) as f:
+    with open(join(grammar_dir, 'dflow.tx')) as f:
         return f.read()
 
 def llm_invoke(system_prompt: str = '', messages: list = [], temperature: float = 0):
+    """ Asks the LLM service through the shared client (see dflow.llm). """
     try:
-        response = requests.post(
-            "https://services.issel.ee.auth.gr/llms/chat",
-            headers={
-                'access_token': ISSEL_API_KEY
-            },
-            json={
-                "system_prompt": system_prompt,
-                "messages": messages
-            },
-            params={
-                "temperature": temperature
-            }
-        )
-        return response.json()['text']
+        return get_llm_client().chat(system_prompt, messages=messages, temperature=temperature)
     except Exception as e:
         detail = f"Could not reach LLM service: {e}"
         print(detail)